@@ -0,0 +1,119 @@
+from datetime import datetime
+
+from pymongo import ASCENDING
+
+from stock import InsufficientStock
+from sale_snapshots import item_snapshot
+
+
+ALLOCATION_FIELDS = {
+    "name": 1,
+    "batch_number": 1,
+    "quantity": 1,
+    "expiry_date": 1,
+    "units_per_strip": 1,
+    "price_per_strip": 1,
+    "price_per_unit": 1,
+    "cost_price_per_unit": 1
+}
+
+
+def load_batches(db, names, now=None, session=None):
+    """Sellable batches for every name, earliest expiry first, in one query.
+
+    Served by the (name, expiry_date, _id) index. Expired batches are
+    excluded by date as well as by the sweep's flag, which batches stored
+    before the sweep existed may not carry yet.
+    """
+    batches = {name: [] for name in names}
+    cursor = db.medicines.find(
+        {"name": {"$in": list(batches)}, "quantity": {"$gt": 0}, "expired": {"$ne": True},
+         "expiry_date": {"$gt": now or datetime.utcnow()}},
+        ALLOCATION_FIELDS, session=session
+    ).sort([("name", ASCENDING), ("expiry_date", ASCENDING), ("_id", ASCENDING)])
+    for med in cursor:
+        batches[med["name"]].append(med)
+    return batches
+
+
+def allocate_fefo(lines, batches):
+    """Split each (name, strips, units) line across batches, first expiry first out.
+
+    Strips are converted to units with the units per strip of the
+    earliest-expiring batch. Several lines for the same name draw on the
+    same batches in turn. Returns a list of (line index, batch, units) and
+    raises InsufficientStock if a name cannot be covered.
+    """
+    remaining = {}
+    picks = []
+    for i, (name, strips, units) in enumerate(lines):
+        candidates = batches.get(name) or []
+        if not candidates:
+            raise InsufficientStock(f"{name} is out of stock.")
+        needed = strips * (candidates[0].get("units_per_strip") or 1) + units
+        if needed <= 0:
+            continue
+        for med in candidates:
+            available = remaining.setdefault(med["_id"], med.get("quantity") or 0)
+            take = min(available, needed)
+            if take <= 0:
+                continue
+            remaining[med["_id"]] = available - take
+            picks.append((i, med, take))
+            needed -= take
+            if needed == 0:
+                break
+        if needed > 0:
+            in_stock = sum(med.get("quantity") or 0 for med in candidates)
+            raise InsufficientStock(f"Only {in_stock} units of {name} left in stock.")
+    return picks
+
+
+def line_price(med, strips, units):
+    return strips * (med.get("price_per_strip") or 0) + units * (med.get("price_per_unit") or 0)
+
+
+def allocated_items(lines, batches, picks):
+    """Sale items for allocate_fefo() picks, one per (line, batch).
+
+    Each line is priced once, for the strips and units asked for, at the
+    prices of its earliest-expiring batch (the one its strips were counted
+    in). The total is then shared between the line's batches by units
+    taken, so splitting a line never changes what it costs. Each item
+    carries a snapshot of its own batch (see sale_snapshots.py).
+    """
+    line_units = {}
+    for line, _, total_units in picks:
+        line_units[line] = line_units.get(line, 0) + total_units
+    billed = {}  # line -> (units, amount) covered by earlier items
+    items = []
+    for line, med, total_units in picks:
+        name, strips, units = lines[line]
+        pricing = batches[name][0]
+        line_total = line_price(pricing, strips, units)
+        done_units, done_amount = billed.get(line, (0, 0))
+        if total_units == line_units[line]:
+            # Unsplit line: recorded as asked for
+            item_strips, item_units = strips, units
+        else:
+            units_per_strip = pricing.get("units_per_strip")
+            # Batches stocked by the unit have no strip size or strip price
+            item_strips, item_units = divmod(total_units, units_per_strip) if units_per_strip else (0, total_units)
+        if done_units + total_units == line_units[line]:
+            # The last part takes what is left, so the parts add up to the line total exactly
+            total = round(line_total - done_amount, 2)
+        else:
+            total = round(line_total * total_units / line_units[line], 2)
+        billed[line] = (done_units + total_units, done_amount + total)
+        items.append({
+            "medicine_id": med["_id"],
+            **item_snapshot(med),
+            "line": line,
+            "strips": item_strips,
+            "units": item_units,
+            "total_units": total_units,
+            "price": total,
+            "total": total,
+            "cost": total_units * (med.get("cost_price_per_unit") or 0)
+        })
+    return items
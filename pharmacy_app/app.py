@@ -1,33 +1,247 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, make_response, jsonify
+from flask import Flask, Response, g, render_template, stream_template, stream_with_context, request, redirect, url_for, flash, make_response, jsonify
 from datetime import datetime, timedelta
 from pymongo import MongoClient, ASCENDING, DESCENDING
 from bson.objectid import ObjectId
 from bson.regex import Regex
-from io import BytesIO
 import os
 import random
+import time
+import threading
 import pytz
-
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.units import inch
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+import click
+from werkzeug.local import LocalProxy
+
+from indexes import ensure_indexes, check_query_plans
+from invoices import get_invoice, invalidate_invoice
+from stock import InsufficientStock, run_transaction, deduct_stock
+from counters import InvoiceNumberAllocator, seed_invoice_counter
+from medicine_search import MedicineSearchIndex
+from dashboard import get_dashboard, dashboard_cache
+from pdf_invoices import get_invoice_pdf, invalidate_invoice_pdf, stream_invoice_zip  # ReportLab loads on first render
+from rollups import apply_rollup, rebuild_rollups, load_report
+from metrics import QueryTracer, begin_request, end_request, render_metrics, slow_commands
+from customer_search import customer_search_keys, customer_search_filter, backfill_customer_search_keys
+from customer_stats import apply_customer_stats, profile_stats, backfill_customer_stats
+from watchlist import (watch_fields, threshold_overrides, refresh_stock_flags, sweep_expired,
+                       ExpirySweeper, backfill_watch_fields)
+from medicine_form import parse_medicine, InvalidMedicine
+from inventory_import import import_medicines, iter_rows
+from allocation import load_batches, allocate_fefo, allocated_items
+from sale_snapshots import backfill_item_snapshots
+from refunds import InvalidRefund, ReversalConflict, void_sale, refund_sale, refundable_units
+from sale_ingest import InvalidBatch, BatchConflict, ingest_sales
+from demand import DEMAND_WINDOW_DAYS, LEAD_TIME_DAYS, demand_report
+from stock_ledger import (movement, record_movements, stock_movements, overwrite_stock, remove_batch, stock_at,
+                          snapshot_stock, verify_stock)
+from inventory_listing import parse_sort, decode_cursor, load_page, iter_listing
+from exports import (FORMATS, SALE_COLUMNS, INVENTORY_COLUMNS, CUSTOMER_COLUMNS, sale_rows, inventory_rows,
+                     customer_rows, encode_rows, gzip_stream)
 
 app = Flask(__name__, static_folder='static')
 app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-key')
 
+# Per-request MongoDB instrumentation. SHOW_DB_STATS=1 adds the round-trip
+# count to response headers and to the page footer.
+SHOW_DB_STATS = os.environ.get("SHOW_DB_STATS") == "1"
+query_tracer = QueryTracer(app.logger, slow_ms=int(os.environ.get("SLOW_COMMAND_MS", 100)))
+
+# The Mongo client (and its SRV/DNS resolution) is created on first database
+# use, once per process, instead of at import, to keep serverless cold starts short
+DATABASE_NAME = os.environ.get("MONGODB_DB", "pharmacy_db")
+_client = None
+_client_lock = threading.Lock()
+
+# Indexes, the invoice counter and backfills are a deploy step (flask init-db).
+# BOOTSTRAP_DATABASE=1 also runs it on each process's first database use,
+# which is convenient locally but costs every serverless cold start.
+BOOTSTRAP_ON_START = os.environ.get("BOOTSTRAP_DATABASE") == "1"
 
-FONT_PATH = os.path.join(os.path.dirname(__file__), "DejaVuSans.ttf")
-pdfmetrics.registerFont(TTFont('DejaVuSans', FONT_PATH))
 
-client = MongoClient(os.environ.get("MONGODB_URI", ""))
-db = client['pharmacy_db']
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(os.environ.get("MONGODB_URI", ""), event_listeners=[query_tracer])
+                if BOOTSTRAP_ON_START:
+                    try:
+                        bootstrap_database(_client[DATABASE_NAME])
+                    except Exception as e:
+                        app.logger.warning(f"Database bootstrap skipped: {e}")
+    return _client
+
+
+client = LocalProxy(get_client)
+db = LocalProxy(lambda: get_client()[DATABASE_NAME])
 
 LOCAL_TIMEZONE = pytz.timezone('Asia/Kolkata')
 
+# Set INVOICE_NUMBER_BLOCK_SIZE > 1 to reserve invoice numbers per worker in blocks
+invoice_numbers = InvoiceNumberAllocator(db, block_size=os.environ.get("INVOICE_NUMBER_BLOCK_SIZE", 1))
+
+# Answers /api/search_medicines from memory; kept current by the write hooks below
+medicine_index = MedicineSearchIndex(rebuild_interval=int(os.environ.get("SEARCH_INDEX_REBUILD_SECONDS", 300)))
+
+# Flags batches past their expiry date; also run on a schedule with `flask sweep-expired`
+expiry_sweeper = ExpirySweeper(interval=int(os.environ.get("EXPIRY_SWEEP_SECONDS", 900)))
+
+
+def sweep_expired_batches():
+    """Run the expiry sweep if it is due and drop newly expired batches from search."""
+    for med_id in expiry_sweeper.maybe_sweep(db, datetime.utcnow()):
+        medicine_index.remove(med_id)
+
+
+def bootstrap_database(database):
+    """Create the indexes the routes depend on, seed the invoice counter and
+    store the watch fields and search keys on documents that predate them.
+
+    All idempotent. Run on deploy with `flask init-db`, or on each process's
+    first database use with BOOTSTRAP_DATABASE=1.
+    """
+    ensure_indexes(database, app.logger)
+    seed_invoice_counter(database)
+    backfill_watch_fields(database, datetime.utcnow(), missing_only=True)
+    backfill_customer_search_keys(database)
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create indexes, seed the invoice counter and backfill older documents; run on every deploy."""
+    bootstrap_database(db)
+    click.echo("Database bootstrapped.")
+
+
+@app.cli.command('init-indexes')
+def init_indexes_command():
+    """Create all indexes used by the routes."""
+    for coll_name, result in ensure_indexes(db, app.logger):
+        click.echo(f"{coll_name}: {result}")
+
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Fail if any route query would run as a collection scan."""
+    failures = check_query_plans(db)
+    for route in failures:
+        click.echo(f"COLLSCAN: {route}")
+    if failures:
+        raise SystemExit(1)
+    click.echo("All route queries use an index.")
+
+
+@app.cli.command('seed-invoice-counter')
+def seed_invoice_counter_command():
+    """Seed the invoice counter from the highest invoice number in sales."""
+    click.echo(f"Invoice counter at {seed_invoice_counter(db)}")
+
+
+@app.cli.command('backfill-customer-search')
+def backfill_customer_search_command():
+    """Store normalized search keys on existing customers."""
+    click.echo(f"Updated {backfill_customer_search_keys(db)} customers")
+
+
+@app.cli.command('backfill-customer-stats')
+@click.option('--batch-size', default=1000, help='Customers updated per bulk write.')
+def backfill_customer_stats_command(batch_size):
+    """Recompute lifetime spend, visits and last visit for every customer."""
+    click.echo(f"Updated stats for {backfill_customer_stats(db, batch_size)} customers")
+
+
+@app.cli.command('sweep-expired')
+def sweep_expired_command():
+    """Flag batches whose expiry date has passed so they are no longer sold."""
+    click.echo(f"Flagged {len(sweep_expired(db, datetime.utcnow()))} expired batches")
+
+
+@app.cli.command('backfill-watchlist')
+@click.option('--batch-size', default=1000, help='Medicines updated per bulk write.')
+def backfill_watchlist_command(batch_size):
+    """Store the low-stock and expiry watch fields on existing medicines."""
+    click.echo(f"Updated {backfill_watch_fields(db, datetime.utcnow(), batch_size)} medicines")
+
+
+@app.cli.command('import-medicines')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--update-existing', is_flag=True, help='Overwrite batches that already exist.')
+@click.option('--chunk-size', default=500, help='Rows validated and written per round trip.')
+def import_medicines_command(path, update_existing, chunk_size):
+    """Add medicine batches from a CSV or XLSX file."""
+    with open(path, 'rb') as f:
+        report = import_medicines(db, iter_rows(f, path), update_existing, chunk_size)
+    for error in report["errors"]:
+        click.echo(f"row {error['row']} ({error['batch_number'] or '-'}): {error['error']}", err=True)
+    click.echo(f"Added {report['inserted']}, updated {report['updated']}, rejected {len(report['errors'])} rows")
+
+
+@app.cli.command('rebuild-rollups')
+@click.option('--batch-size', default=1000, help='Sales read per batch.')
+def rebuild_rollups_command(batch_size):
+    """Recompute the daily sales rollups from raw sales."""
+    click.echo(f"Rolled up {rebuild_rollups(db, LOCAL_TIMEZONE, batch_size)} sales")
+
+
+@app.cli.command('snapshot-stock')
+@click.option('--batch-size', default=500, help='Batches read per chunk.')
+def snapshot_stock_command(batch_size):
+    """Snapshot the quantity of every batch that moved since its last snapshot; run from cron.
+
+    Run it once right after deploying, so batches stocked before the ledger have a baseline.
+    """
+    click.echo(f"Wrote {snapshot_stock(db, batch_size=batch_size)} stock snapshots")
+
+
+@app.cli.command('verify-stock-ledger')
+@click.option('--batch-size', default=500, help='Batches checked per chunk.')
+def verify_stock_ledger_command(batch_size):
+    """Compare every batch's quantity with its latest snapshot plus later movements."""
+    mismatches = 0
+    unchecked = 0
+    for med_id, stored, expected in verify_stock(db, batch_size):
+        if expected is None:
+            unchecked += 1
+            continue
+        mismatches += 1
+        click.echo(f"{med_id}: stored {stored}, ledger {expected}")
+    click.echo(f"{mismatches} mismatched batches")
+    if unchecked:
+        click.echo(f"{unchecked} batches without a snapshot were skipped; run snapshot-stock first")
+
+
+@app.cli.command('backfill-sale-snapshots')
+@click.option('--batch-size', default=500, help='Sales updated per bulk write.')
+def backfill_sale_snapshots_command(batch_size):
+    """Copy medicine name, batch and prices into sale lines recorded before snapshots.
+
+    Run it while the app is idle.
+    """
+    click.echo(f"Updated {backfill_item_snapshots(db, batch_size)} sales")
+
+@app.before_request
+def start_db_stats():
+    begin_request()
+
+
+@app.after_request
+def record_db_stats(response):
+    return end_request(response, add_header=SHOW_DB_STATS)
+
+
+@app.context_processor
+def inject_db_stats():
+    return {"db_stats": g.get("db_stats") if SHOW_DB_STATS else None}
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/slow')
+def slow_queries():
+    return jsonify(list(slow_commands))
+
 @app.template_filter('local_datetime')
 def local_datetime_filter(dt):
     if isinstance(dt, str):
@@ -36,141 +250,86 @@ def local_datetime_filter(dt):
         dt = pytz.utc.localize(dt)
     return dt.astimezone(LOCAL_TIMEZONE).strftime('%Y-%m-%d %H:%M:%S')
 
+@app.template_filter('local_date')
+def local_date_filter(dt):
+    return local_datetime_filter(dt)[:10]
+
 @app.route('/')
 def dashboard():
     today_utc = datetime.utcnow()
-    expiry_threshold = today_utc + timedelta(days=30)
-
-    # Convert expiry_date from MongoDB to Python datetime if stored as ISODate
-    expiring_meds = []
-    for med in db.medicines.find({"expiry_date": {"$lte": expiry_threshold}}).sort("expiry_date"):
-        med['expiry_date'] = med['expiry_date'].strftime('%Y-%m-%d') if isinstance(med['expiry_date'], datetime) else med['expiry_date']
-        expiring_meds.append(med)
+    sweep_expired_batches()
 
-    low_stock = list(db.medicines.find({"quantity": {"$lt": 10}}))
+    started = time.perf_counter()
+    summary, cache_hit = get_dashboard(db, today_utc)
+    elapsed_ms = (time.perf_counter() - started) * 1000
 
-    # Prepare recent sales data
-    recent_sales = []
-    for sale in db.sales.find().sort("date", DESCENDING).limit(5):
-        sale['invoice_number'] = sale.get('invoice_number', str(sale['_id'])[-6:])  # fallback if invoice_number not set
-        sale['date'] = sale['date'] if isinstance(sale['date'], datetime) else datetime.fromtimestamp(sale['date'] / 1000)
-        sale['customer_name'] = sale.get('customer_name', 'Walk-in')
-        sale['total_amount'] = float(sale['total_amount'])
-        recent_sales.append(sale)
-
-    return render_template(
+    response = make_response(render_template(
         'dashboard.html',
-        expiring_meds=expiring_meds,
-        low_stock=low_stock,
-        recent_sales=recent_sales,
+        expiring_meds=summary["expiring_meds"],
+        low_stock=summary["low_stock"],
+        recent_sales=summary["recent_sales"],
         datetime=datetime,
         now=today_utc
-    )
+    ))
+    # Visible in the browser's network panel
+    response.headers['Server-Timing'] = f'dashboard;dur={elapsed_ms:.1f};desc="{"cache" if cache_hit else "db"}"'
+    return response
+
+
+def render_listing(general, template, endpoint):
+    """Shared body of inventory() and general_inventory().
+
+    Pages are keyset-paginated on (sort field, _id) via ?after=; ?all=1
+    streams the whole filtered listing so the first rows render immediately.
+    """
+    search_query = request.args.get('search', '').strip()
+    sort, direction = parse_sort(request.args)
+    listing = {"search": search_query, "sort": sort, "dir": "desc" if direction == DESCENDING else "asc"}
+
+    if request.args.get('all') == '1':
+        return Response(stream_template(template, medicines=iter_listing(db, general, search_query, sort, direction),
+                                        listing=listing, endpoint=endpoint, next_cursor=None,
+                                        is_first_page=True, show_all=True))
+
+    after = request.args.get('after', '').strip()
+    try:
+        cursor = decode_cursor(after) if after else None
+    except Exception:
+        flash('Invalid page link.', 'danger')
+        return redirect(url_for(endpoint, **listing))
+    medicines, next_cursor = load_page(db, general, search_query, sort, direction, after=cursor)
+    return render_template(template, medicines=medicines, listing=listing, endpoint=endpoint,
+                           next_cursor=next_cursor, is_first_page=not after, show_all=False)
 
 
 @app.route('/inventory')
 def inventory():
-    search_query = request.args.get('search', '').strip()
-    query = {"general": False}
-    if search_query:
-        query["$or"] = [
-            {"name": {"$regex": search_query, "$options": "i"}},
-            {"batch_number": {"$regex": search_query, "$options": "i"}},
-            {"supplier": {"$regex": search_query, "$options": "i"}}
-        ]
-    medicines = list(db.medicines.find(query).sort("name", 1))
-    for med in medicines:
-        if isinstance(med.get('mfg_date'), datetime):
-            med['mfg_date'] = med['mfg_date'].strftime('%Y-%m-%d')
-        if isinstance(med.get('expiry_date'), datetime):
-            med['expiry_date'] = med['expiry_date'].strftime('%Y-%m-%d')
-    for med in medicines:
-        units_per_strip = med.get('units_per_strip', 1) or 1
-        total_units = med.get('quantity', 0) or 0
-
-        strips = total_units // units_per_strip
-        loose_units = total_units % units_per_strip
-
-        med['stock_display'] = f"{strips} strips & {loose_units} units"
-    return render_template('inventory/list.html', medicines=medicines)
+    return render_listing(False, 'inventory/list.html', 'inventory')
 
 @app.route('/inventory/add', methods=['GET', 'POST'])
 def add_medicine():
     if request.method == 'POST':
         try:
-            add_by = request.form.get('add_by')  # "strip" or "unit"
-            name = request.form['name'].strip()
-            batch_number = request.form['batch_number'].strip()
-            supplier = request.form.get('supplier', '').strip()
-            company = request.form.get('company', '').strip()
-            mfg_date = datetime.strptime(request.form['mfg_date'], '%Y-%m-%d')
-            expiry_date = datetime.strptime(request.form['expiry_date'], '%Y-%m-%d')
-            general = False
-
-            # Fields that will always exist in DB
-            units_per_strip = None
-            price_per_strip = None
-            price_per_unit = None
-            total_units = 0
-
-            if add_by == 'strip':
-                # Expect strips_count, units_per_strip and price_per_strip
-                strips_count = float(request.form.get('strips_count', '0') or 0)   # allow decimals like 1.5 if user enters mistakenly - but we'll convert only for storage as integer units
-                units_per_strip = int(request.form.get('units_per_strip', '0') or 0)
-                price_per_strip = float(request.form.get('price_per_strip', '0') or 0)
-
-                if units_per_strip <= 0:
-                    flash('Units per strip must be a positive integer.', 'danger')
-                    return render_template('inventory/add.html')
-
-                if strips_count < 0:
-                    flash('Number of strips cannot be negative.', 'danger')
-                    return render_template('inventory/add.html')
-
-                # Calculate total units (allow non-integer strips like 1.5 -> multiply and round to nearest unit)
-                total_units = int(round(strips_count * units_per_strip))
-
-                # price_per_unit computed but user can override in form; prefer explicit per-unit if provided
-                price_per_unit_input = request.form.get('price_per_unit', '').strip()
-                if price_per_unit_input != '':
-                    price_per_unit = float(price_per_unit_input)
-                else:
-                    # avoid division by zero (units_per_strip > 0 ensured above)
-                    price_per_unit = price_per_strip / units_per_strip if price_per_strip is not None else 0.0
-
-            else:  # add_by == 'unit' or default
-                price_per_unit = float(request.form.get('price_per_unit', '0') or 0)
-                units_count = int(request.form.get('quantity', '0') or 0)
-                if units_count < 0:
-                    flash('Quantity cannot be negative.', 'danger')
-                    return render_template('inventory/add.html')
-                total_units = units_count
-                # price_per_strip remains None (unless user later sets it)
-
-            # Common numeric fields: cost_price (rate) stored per unit (user provides)
-            cost_price = float(request.form.get('cost_price', '0') or 0)
+            try:
+                med = parse_medicine(request.form)
+            except InvalidMedicine as e:
+                flash(str(e), 'danger')
+                return render_template('inventory/add.html')
 
             # Check duplicate batch
-            if db.medicines.find_one({"batch_number": batch_number}):
+            if db.medicines.find_one({"batch_number": med["batch_number"]}):
                 flash('Batch number already exists!', 'danger')
                 return render_template('inventory/add.html')
 
-            med = {
-                "name": name,
-                "batch_number": batch_number,
-                "quantity": total_units,
-                "price_per_unit": round(float(price_per_unit or 0), 2),
-                "price_per_strip": round(float(price_per_strip) if price_per_strip is not None else None, 2) if price_per_strip is not None else None,
-                "units_per_strip": int(units_per_strip) if units_per_strip is not None else None,
-                "cost_price_per_unit": round(float(cost_price or 0), 2),
-                "supplier": supplier,
-                "company": company,
-                "mfg_date": mfg_date,
-                "expiry_date": expiry_date,
-                "general": general
-            }
+            med.update(watch_fields(med, datetime.utcnow()))
+
+            def receive(session):
+                db.medicines.insert_one(med, session=session)
+                record_movements(db, [movement(med["_id"], med["quantity"], "received")], session=session)
 
-            db.medicines.insert_one(med)
+            run_transaction(client, receive)
+            medicine_index.upsert(med)
+            dashboard_cache.clear()
             flash('Medicine added successfully!', 'success')
             return redirect(url_for('inventory'))
 
@@ -182,6 +341,35 @@ def add_medicine():
     return render_template('inventory/add.html')
 
 
+@app.route('/inventory/import', methods=['GET', 'POST'])
+def import_inventory():
+    """Bulk-add batches from a CSV or XLSX file; answers JSON to API clients."""
+    if request.method == 'GET':
+        return render_template('inventory/import.html', report=None)
+
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Choose a CSV or XLSX file to import.', 'danger')
+        return redirect(url_for('import_inventory'))
+    try:
+        report = import_medicines(db, iter_rows(upload.stream, upload.filename),
+                                  update_existing=request.form.get('update_existing') == '1')
+    except ImportError:
+        flash('XLSX import needs the openpyxl package. Save the sheet as CSV and try again.', 'danger')
+        return redirect(url_for('import_inventory'))
+    except Exception as e:
+        app.logger.exception("Error importing medicines")
+        flash(f'Import stopped: {str(e)}', 'danger')
+        return redirect(url_for('import_inventory'))
+
+    if report["inserted"] or report["updated"]:
+        medicine_index.rebuild(db)
+        dashboard_cache.clear()
+    if request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+        return jsonify(report)
+    return render_template('inventory/import.html', report=report)
+
+
 @app.route('/inventory/edit/<id>', methods=['GET', 'POST'])
 def edit_medicine(id):
     medicine = db.medicines.find_one({"_id": ObjectId(id)})
@@ -199,9 +387,13 @@ def edit_medicine(id):
                 "supplier": request.form['supplier'],
                 "company": request.form['company'],
                 "mfg_date": datetime.strptime(request.form['mfg_date'], '%Y-%m-%d'),
-                "expiry_date": datetime.strptime(request.form['expiry_date'], '%Y-%m-%d')
+                "expiry_date": datetime.strptime(request.form['expiry_date'], '%Y-%m-%d'),
+                **threshold_overrides(request.form)
             }
-            db.medicines.update_one({"_id": ObjectId(id)}, {"$set": update})
+            update.update(watch_fields({**medicine, **update}, datetime.utcnow()))
+            run_transaction(client, lambda session: overwrite_stock(db, ObjectId(id), update, session=session))
+            medicine_index.refresh(db, [ObjectId(id)])
+            dashboard_cache.clear()
             flash('Medicine updated successfully!', 'success')
             return redirect(url_for('inventory'))
         except Exception as e:
@@ -211,7 +403,9 @@ def edit_medicine(id):
 @app.route('/inventory/delete/<id>')
 def delete_medicine(id):
     try:
-        db.medicines.delete_one({"_id": ObjectId(id)})
+        run_transaction(client, lambda session: remove_batch(db, ObjectId(id), session=session))
+        medicine_index.remove(ObjectId(id))
+        dashboard_cache.clear()
         flash('Medicine deleted.', 'success')
     except Exception as e:
         flash(f'Failed to delete: {str(e)}', 'danger')
@@ -221,33 +415,7 @@ def delete_medicine(id):
 # General Inventory
 @app.route('/general')
 def general_inventory():
-    search_query = request.args.get('search', '').strip()
-    query = {'general': True}
-
-    if search_query:
-        query = {
-            '$and': [
-                {'general': True},
-                {
-                    '$or': [
-                        {'name': {'$regex': search_query, '$options': 'i'}},
-                        {'batch_number': {'$regex': search_query, '$options': 'i'}},
-                        {'supplier': {'$regex': search_query, '$options': 'i'}}
-                    ]
-                }
-            ]
-        }
-
-    medicines = list(db.medicines.find(query).sort('name', 1))
-
-    # Format MongoDB date fields for template display
-    for med in medicines:
-        if isinstance(med.get('mfg_date'), datetime):
-            med['mfg_date'] = med['mfg_date'].strftime('%Y-%m-%d')
-        if isinstance(med.get('expiry_date'), datetime):
-            med['expiry_date'] = med['expiry_date'].strftime('%Y-%m-%d')
-
-    return render_template('general/list.html', medicines=medicines)
+    return render_listing(True, 'general/list.html', 'general_inventory')
 
 @app.route('/general/add', methods=['GET', 'POST'])
 def add_general():
@@ -264,7 +432,15 @@ def add_general():
                 "expiry_date": datetime.strptime(request.form['expiry_date'], '%Y-%m-%d'),
                 "general": True
             }
-            db.medicines.insert_one(item)
+            item.update(watch_fields(item, datetime.utcnow()))
+
+            def receive(session):
+                db.medicines.insert_one(item, session=session)
+                record_movements(db, [movement(item["_id"], item["quantity"], "received")], session=session)
+
+            run_transaction(client, receive)
+            medicine_index.upsert(item)
+            dashboard_cache.clear()
             flash('Item added.', 'success')
             return redirect(url_for('general_inventory'))
         except Exception as e:
@@ -288,9 +464,13 @@ def edit_general(id):
                 "supplier": request.form['supplier'],
                 "company": request.form['company'],
                 "mfg_date": datetime.strptime(request.form['mfg_date'], '%Y-%m-%d'),
-                "expiry_date": datetime.strptime(request.form['expiry_date'], '%Y-%m-%d')
+                "expiry_date": datetime.strptime(request.form['expiry_date'], '%Y-%m-%d'),
+                **threshold_overrides(request.form)
             }
-            db.medicines.update_one({"_id": ObjectId(id)}, {"$set": update})
+            update.update(watch_fields({**item, **update}, datetime.utcnow()))
+            run_transaction(client, lambda session: overwrite_stock(db, ObjectId(id), update, session=session))
+            medicine_index.refresh(db, [ObjectId(id)])
+            dashboard_cache.clear()
             flash('Item updated successfully!', 'success')
             return redirect(url_for('general_inventory'))
         except Exception as e:
@@ -301,7 +481,9 @@ def edit_general(id):
 @app.route('/general/delete/<id>')
 def delete_general(id):
     try:
-        db.medicines.delete_one({"_id": ObjectId(id)})
+        run_transaction(client, lambda session: remove_batch(db, ObjectId(id), session=session))
+        medicine_index.remove(ObjectId(id))
+        dashboard_cache.clear()
         flash('Item deleted.', 'success')
     except Exception as e:
         flash(f'Error deleting item: {str(e)}', 'danger')
@@ -321,6 +503,7 @@ def add_customer():
                 "name": request.form['name'],
                 "phone": request.form['phone'],
                 "address": request.form.get('address'),
+                "search_keys": customer_search_keys(request.form['name'], request.form['phone'])
             }
             db.customers.insert_one(customer)
             flash('Customer added successfully!', 'success')
@@ -341,7 +524,8 @@ def edit_customer(id):
             update = {
                 "name": request.form['name'],
                 "phone": request.form['phone'],
-                "address": request.form.get('address')
+                "address": request.form.get('address'),
+                "search_keys": customer_search_keys(request.form['name'], request.form['phone'])
             }
             db.customers.update_one({"_id": ObjectId(id)}, {"$set": update})
             flash('Customer updated successfully!', 'success')
@@ -351,6 +535,9 @@ def edit_customer(id):
 
     return render_template('customers/edit.html', customer=customer)
 
+CUSTOMER_HISTORY_PAGE_SIZE = 20
+
+
 @app.route('/customers/view/<id>')
 def view_customer(id):
     customer = db.customers.find_one({"_id": ObjectId(id)})
@@ -358,15 +545,37 @@ def view_customer(id):
         flash('Customer not found!', 'danger')
         return redirect(url_for('customers'))
 
-    # Fetch sales related to this customer
-    sales = list(db.sales.find({"customer_id": ObjectId(id)}).sort("date", DESCENDING))
+    # One page of sales history, newest first, keyset-paginated on (date, _id)
+    query = {"customer_id": customer["_id"]}
+    before = request.args.get('before', '').strip()
+    if before:
+        try:
+            before_date, before_id = decode_sale_cursor(before)
+        except Exception:
+            flash('Invalid page link.', 'danger')
+            return redirect(url_for('view_customer', id=id))
+        query["$or"] = [
+            {"date": {"$lt": before_date}},
+            {"date": before_date, "_id": {"$lt": before_id}}
+        ]
+    sales = list(
+        db.sales.find(query, {"invoice_number": 1, "date": 1, "total_amount": 1, "payment_method": 1})
+        .sort([("date", DESCENDING), ("_id", DESCENDING)])
+        .limit(CUSTOMER_HISTORY_PAGE_SIZE + 1)
+    )
+
+    next_cursor = None
+    if len(sales) > CUSTOMER_HISTORY_PAGE_SIZE:
+        sales = sales[:CUSTOMER_HISTORY_PAGE_SIZE]
+        next_cursor = encode_sale_cursor(sales[-1])
 
     # Convert ObjectId to string for template usage
     for sale in sales:
         sale["_id"] = str(sale["_id"])
         sale["date"] = sale["date"].strftime('%Y-%m-%d') if isinstance(sale["date"], datetime) else sale["date"]
 
-    return render_template('customers/view.html', customer=customer, sales=sales)
+    return render_template('customers/view.html', customer=customer, sales=sales,
+                           stats=profile_stats(customer), next_cursor=next_cursor, is_first_page=not before)
 
 
 @app.route('/customers/delete/<id>')
@@ -388,35 +597,74 @@ def search_medicines():
         return jsonify(medicines_list)
 
     try:
-        # Search by name, ensure stock > 0 and not expired
-        medicines = db.medicines.find(
-            {
-                "name": {"$regex": query, "$options": "i"},
-                "quantity": {"$gt": 0},
-                "expiry_date": {"$gt": datetime.now()}
-            },
-            {
-                "_id": 1,
-                "name": 1,
-                "batch_number": 1,
-                "price": 1,
-                "price_per_unit": 1,
-                "price_per_strip": 1,
-                "units_per_strip": 1,
-                "quantity": 1
-            }
-        ).sort([("name", 1), ("batch_number", 1)]).limit(10)
-
-        # Convert ObjectId to string for JSON serialization
-        for med in medicines:
-            med["_id"] = str(med["_id"])
-            medicines_list.append(med)
-
+        # Search by name, ensure stock > 0 and not flagged expired
+        sweep_expired_batches()
+        medicines_list = medicine_index.search(db, query, limit=10)
         return jsonify(medicines_list)
     except Exception as e:
         app.logger.error(f"Error searching medicines: {e}")
         return jsonify({"error": "Failed to search medicines"}), 500
 
+@app.route('/api/catalog_snapshot')
+def catalog_snapshot():
+    """Every sellable batch in one compact document, for the sale form to search offline.
+
+    Revalidated with If-None-Match; the ETag changes whenever stock or the catalog does.
+    """
+    try:
+        sweep_expired_batches()
+        etag, body = medicine_index.snapshot(db)
+    except Exception as e:
+        app.logger.error(f"Error building catalog snapshot: {e}")
+        return jsonify({"error": "Failed to load catalog"}), 500
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/api/stock/<medicine_id>')
+def stock_history(medicine_id):
+    """Quantity of a batch at ?at=<ISO 8601 UTC> (default now), with the movements since the snapshot used."""
+    try:
+        med_id = ObjectId(medicine_id)
+        at = datetime.fromisoformat(request.args['at']) if request.args.get('at') else datetime.utcnow()
+    except Exception:
+        return jsonify({"error": "Invalid medicine id or time"}), 400
+    if at.tzinfo is not None:
+        at = at.astimezone(pytz.utc).replace(tzinfo=None)
+
+    state = stock_at(db, med_id, at)
+    if state is None:
+        return jsonify({"error": "No stock history for this batch at that time"}), 404
+    for m in state["movements"]:
+        m["ref"] = str(m["ref"]) if m.get("ref") else None
+    return jsonify({"medicine_id": medicine_id, "at": at.isoformat(), **state})
+
+@app.route('/api/sales/batch', methods=['POST'])
+def ingest_sales_batch():
+    """Record a batch of sales uploaded by a till; see sale_ingest.py for the format.
+
+    Safe to retry: sales whose idempotency_key is already recorded come back as duplicates.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"error": 'Expected {"sales": [...]}.'}), 400
+    try:
+        results, sold = ingest_sales(db, client, invoice_numbers, payload.get("sales"),
+                                     LOCAL_TIMEZONE, datetime.utcnow())
+    except InvalidBatch as e:
+        return jsonify({"error": str(e)}), 400
+    except (InsufficientStock, BatchConflict) as e:
+        return jsonify({"error": str(e)}), 409
+    except Exception as e:
+        app.logger.error(f"Error ingesting sales: {e}")
+        return jsonify({"error": "Failed to record sales"}), 500
+
+    if sold:
+        medicine_index.adjust_stock(db, {med_id: -units for med_id, units in sold.items()})
+        dashboard_cache.clear()
+    return jsonify({"results": results})
+
 @app.route('/api/search_customers')
 def search_customers():
     """API endpoint to search for customers."""
@@ -428,12 +676,7 @@ def search_customers():
 
     try:
         customers = db.customers.find(
-            {
-                "$or": [
-                    {"name": {"$regex": query, "$options": "i"}},
-                    {"phone": {"$regex": query, "$options": "i"}}
-                ]
-            },
+            customer_search_filter(query),
             {
                 "_id": 1,
                 "name": 1,
@@ -451,88 +694,118 @@ def search_customers():
         return jsonify({"error": "Failed to search customers"}), 500
     
 
+SALES_PAGE_SIZE = 50
+
+
+def local_date_to_utc(date_str):
+    """Convert a YYYY-MM-DD local date into the naive UTC datetime of its midnight."""
+    local_midnight = LOCAL_TIMEZONE.localize(datetime.strptime(date_str, '%Y-%m-%d'))
+    return local_midnight.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def encode_sale_cursor(sale):
+    return f"{sale['date'].isoformat()}_{sale['_id']}"
+
+
+def decode_sale_cursor(cursor):
+    date_str, sale_id = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(date_str), ObjectId(sale_id)
+
+
 @app.route('/sales')
 def sales():
-    sales_list = []
-    for s in db.sales.find().sort("date", -1):
-        # Attach customer name (if exists)
-        if s.get("customer_id"):
-            customer = db.customers.find_one({"_id": ObjectId(s["customer_id"])})
-            s["customer_name"] = customer["name"] if customer else "Walk-in Customer"
-            s["customer_phone"] = customer.get("phone", "") if customer else ""
-        else:
-            s["customer_name"] = "Walk-in Customer"
-            s["customer_phone"] = ""
+    date_from = request.args.get('from', '').strip()
+    date_to = request.args.get('to', '').strip()
+    payment_method = request.args.get('payment_method', '').strip()
+    before = request.args.get('before', '').strip()
 
+    match = {}
+    try:
+        if date_from or date_to:
+            match["date"] = {}
+            if date_from:
+                match["date"]["$gte"] = local_date_to_utc(date_from)
+            if date_to:
+                match["date"]["$lt"] = local_date_to_utc(date_to) + timedelta(days=1)
+        if before:
+            # Keyset pagination: everything strictly older than the last row shown
+            before_date, before_id = decode_sale_cursor(before)
+            match["$or"] = [
+                {"date": {"$lt": before_date}},
+                {"date": before_date, "_id": {"$lt": before_id}}
+            ]
+    except Exception:
+        flash('Invalid filter value.', 'danger')
+        return redirect(url_for('sales'))
+    if payment_method:
+        match["payment_method"] = payment_method
+
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"date": -1, "_id": -1}},
+        {"$limit": SALES_PAGE_SIZE + 1},
+        {"$lookup": {
+            "from": "customers",
+            "localField": "customer_id",
+            "foreignField": "_id",
+            "as": "customer"
+        }},
+        {"$project": {
+            "invoice_number": 1,
+            "date": 1,
+            "total_amount": 1,
+            "payment_method": 1,
+            "customer_name": {"$ifNull": [{"$arrayElemAt": ["$customer.name", 0]}, "Walk-in Customer"]},
+            "customer_phone": {"$ifNull": [{"$arrayElemAt": ["$customer.phone", 0]}, ""]}
+        }}
+    ]
+    sales_list = list(db.sales.aggregate(pipeline))
+
+    next_cursor = None
+    if len(sales_list) > SALES_PAGE_SIZE:
+        sales_list = sales_list[:SALES_PAGE_SIZE]
+        next_cursor = encode_sale_cursor(sales_list[-1])
+
+    for s in sales_list:
         # Convert ObjectId to string for template usage
         s["_id"] = str(s["_id"])
-        sales_list.append(s)
 
-    return render_template('sales/list.html', sales=sales_list)
+    filters = {"from": date_from, "to": date_to, "payment_method": payment_method}
+    return render_template('sales/list.html', sales=sales_list, next_cursor=next_cursor,
+                           filters=filters, is_first_page=not before)
 
 # Sales
 @app.route('/sales/new', methods=['GET', 'POST'])
 def new_sale():
-    customers = list(db.customers.find())
-    medicines = list(db.medicines.find({"quantity": {"$gt": 0}}))
-
     if request.method == 'POST':
         try:
             customer_id = request.form.get('customer_id')
             payment_method = request.form.get('payment_method')
             discount = float(request.form.get('discount', 0) or 0)
 
-            medicine_ids = request.form.getlist('medicine_ids[]')
-            strips_list = request.form.getlist('strips[]')
-            units_list = request.form.getlist('units[]')
-            prices = request.form.getlist('prices[]')
+            names = request.form.getlist('names[]')
+            strips_list = [int(s or 0) for s in request.form.getlist('strips[]')]
+            units_list = [int(u or 0) for u in request.form.getlist('units[]')]
 
-            if not medicine_ids or not prices:
+            if not names:
                 return jsonify({"error": "No medicines selected"}), 400
 
-            strips_list = [int(s or 0) for s in strips_list]
-            units_list = [int(u or 0) for u in units_list]
-            prices = [float(p) for p in prices]
+            # Lines name a medicine; split each across its batches, first expiry first out
+            lines = list(zip(names, strips_list, units_list))
+            batches = load_batches(db, set(names))
+            picks = allocate_fefo(lines, batches)
+            items = allocated_items(lines, batches, picks)
+            units_by_medicine = {}
+            for _, med, total_units in picks:
+                units_by_medicine[med["_id"]] = units_by_medicine.get(med["_id"], 0) + total_units
 
-            items = []
-            total_amount = 0
-
-            for med_id, strips, units, price in zip(medicine_ids, strips_list, units_list, prices):
-                med = db.medicines.find_one({"_id": ObjectId(med_id)})
-                if not med:
-                    continue
-                print("data:", med_id, strips, units, price)
-
-                units_per_strip = med.get("units_per_strip", 1)
-                total_units = strips * units_per_strip + units
-
-                # Calculate total price based on units
-                total_amount += strips * med.get("price_per_strip", 0) + units * med.get("price_per_unit", 0)
-
-                # Store in items
-                items.append({
-                    "medicine_id": ObjectId(med_id),
-                    "strips": strips,
-                    "units": units,
-                    "total_units": total_units,
-                    "price": price
-                })
-
-                # Deduct stock in units
-                db.medicines.update_one(
-                    {"_id": ObjectId(med_id)},
-                    {"$inc": {"quantity": -total_units}}
-                )
+            total_amount = sum(item["total"] for item in items)
 
             # Apply discount
             total_amount -= discount
 
             # Generate invoice number
-            last_sale = db.sales.find_one(sort=[("invoice_number", -1)])
-            if last_sale and "invoice_number" in last_sale:
-                invoice_number = last_sale["invoice_number"] + 1
-            else:
-                invoice_number = 1001
+            invoice_number = invoice_numbers.next_number()
 
             # Insert sale record
             sale_doc = {
@@ -544,113 +817,151 @@ def new_sale():
                 "items": items,
                 "date": datetime.utcnow()
             }
-            db.sales.insert_one(sale_doc)
+
+            # Deduct stock (in units) and record the sale atomically
+            def record_sale(session):
+                deduct_stock(db, units_by_medicine, session=session)
+                db.sales.insert_one(sale_doc, session=session)
+                record_movements(db, stock_movements(units_by_medicine, -1, "sold", sale_doc["_id"]), session=session)
+                apply_rollup(db, sale_doc, LOCAL_TIMEZONE, session=session)
+                apply_customer_stats(db, sale_doc, session=session)
+                refresh_stock_flags(db, units_by_medicine, session=session)
+
+            run_transaction(client, record_sale)
+            medicine_index.adjust_stock(db, {med_id: -units for med_id, units in units_by_medicine.items()})
+            dashboard_cache.clear()
 
             flash(f"Sale recorded successfully! Invoice #{invoice_number}", "success")
             return redirect(url_for('sales'))
 
+        except InsufficientStock as e:
+            flash(str(e), "danger")
+            return redirect(url_for('new_sale'))
         except Exception as e:
             app.logger.error(f"Error processing sale: {e}")
             return jsonify({"error": "Failed to process sale"}), 500
 
-    return render_template('sales/new.html', customers=customers, medicines=medicines)
+    return render_template('sales/new.html')
 
 
 @app.route('/sales/<sale_id>')
 def view_invoice(sale_id):
     try:
-        sale = db.sales.find_one({"_id": ObjectId(sale_id)})
+        invoice = get_invoice(db, sale_id)
     except:
         flash("Invalid sale ID.", "danger")
         return redirect(url_for('sales'))
 
-    if not sale:
+    if not invoice:
         flash('Invoice not found.', 'danger')
         return redirect(url_for('sales'))
 
-    # Attach customer info
-    if sale.get("customer_id"):
-        customer = db.customers.find_one({"_id": ObjectId(sale["customer_id"])})
-        sale["customer_name"] = customer["name"] if customer else "Walk-in Customer"
-        sale["customer_phone"] = customer.get("phone", "") if customer else ""
-        sale["customer_address"] = customer.get("address", "") if customer else ""
-    else:
-        sale["customer_name"] = "Walk-in Customer"
-        sale["customer_phone"] = ""
-        sale["customer_address"] = ""
-
-    # Get medicine details with strips & units
-    items_with_details = []
-    for item in sale.get("items", []):
-        med = db.medicines.find_one({"_id": ObjectId(item["medicine_id"])})
-        if med:
-            # units_per_strip = med.get("units_per_strip", 1) or 1  # avoid division by zero
-            strips = item['strips']
-            units = item['units']
-
-            items_with_details.append({
-                "medicine_name": med["name"],
-                "batch_number": med.get("batch_number", ""),
-                "quantity": f"{strips} strips & {units} units",
-                "ps": med.get('price_per_strip', 0),
-                "pu": med.get('price_per_unit', 0),
-                "total": strips * med.get("price_per_strip", 0) + units * med.get("price_per_unit", 0),
-            })
-
     return render_template(
         'sales/invoice.html',
-        sale=sale,
-        items=items_with_details,
+        sale=invoice["sale"],
+        items=invoice["items"],
         current_time=datetime.now()
     )
+
 @app.route('/sales/print/<sale_id>')
 def print_invoice_html(sale_id):
     try:
-        sale = db.sales.find_one({"_id": ObjectId(sale_id)})
+        invoice = get_invoice(db, sale_id)
     except:
         flash("Invalid sale ID.", "danger")
         return redirect(url_for('sales'))
 
-    if not sale:
+    if not invoice:
         flash('Invoice not found.', 'danger')
         return redirect(url_for('sales'))
 
-    # Attach customer info
-    if sale.get("customer_id"):
-        customer = db.customers.find_one({"_id": ObjectId(sale["customer_id"])})
-        sale["customer_name"] = customer["name"] if customer else "Walk-in Customer"
-        sale["customer_phone"] = customer.get("phone", "") if customer else ""
-        sale["customer_address"] = customer.get("address", "") if customer else ""
-    else:
-        sale["customer_name"] = "Walk-in Customer"
-        sale["customer_phone"] = ""
-        sale["customer_address"] = ""
-
-    # Get medicine details with strips & units
-    items_with_details = []
-    for item in sale.get("items", []):
-        med = db.medicines.find_one({"_id": ObjectId(item["medicine_id"])})
-        if med:
-            # units_per_strip = med.get("units_per_strip", 1) or 1  # avoid division by zero
-            strips = item['strips']
-            units = item['units']
-
-            items_with_details.append({
-                "medicine_name": med["name"],
-                "batch_number": med.get("batch_number", ""),
-                "quantity": f"{strips} strips & {units} units",
-                "ps": med.get('price_per_strip', 0),
-                "pu": med.get('price_per_unit', 0),
-                "total": strips * med.get("price_per_strip", 0) + units * med.get("price_per_unit", 0),
-            })
+    # The print page has no flashed messages or per-request state, so the
+    # rendered HTML can be reused for reprints
+    html = invoice["html"].get('sales/invoice_print.html')
+    if html is None:
+        html = render_template(
+            'sales/invoice_print.html',
+            sale=invoice["sale"],
+            items=invoice["items"],
+            current_time=datetime.now()
+        )
+        invoice["html"]['sales/invoice_print.html'] = html
+    return html
+
+@app.route('/sales/<sale_id>/pdf')
+def invoice_pdf(sale_id):
+    try:
+        invoice = get_invoice(db, sale_id)
+    except:
+        flash("Invalid sale ID.", "danger")
+        return redirect(url_for('sales'))
 
-    return render_template(
-        'sales/invoice_print.html',
-        sale=sale,
-        items=items_with_details,
-        current_time=datetime.now()
+    if not invoice:
+        flash('Invoice not found.', 'danger')
+        return redirect(url_for('sales'))
+
+    pdf = get_invoice_pdf(invoice["sale"], invoice["items"], LOCAL_TIMEZONE)
+    response = make_response(pdf)
+    response.headers['Content-Type'] = 'application/pdf'
+    response.headers['Content-Disposition'] = f'inline; filename=invoice-{invoice["sale"].get("invoice_number", sale_id)}.pdf'
+    return response
+
+@app.route('/sales/export/pdf')
+def export_invoices_pdf():
+    date_from = request.args.get('from', '').strip()
+    date_to = request.args.get('to', '').strip()
+    try:
+        start = local_date_to_utc(date_from)
+        end = local_date_to_utc(date_to) + timedelta(days=1)
+    except ValueError:
+        flash('Choose a valid date range to export.', 'danger')
+        return redirect(url_for('sales'))
+
+    return Response(
+        stream_with_context(stream_invoice_zip(db, {"date": {"$gte": start, "$lt": end}}, LOCAL_TIMEZONE)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename=invoices-{date_from}-to-{date_to}.zip'}
     )
 
+@app.route('/export/<dataset>.<fmt>')
+def export_data(dataset, fmt):
+    """Stream sales line items, inventory or customers as CSV or NDJSON.
+
+    Sales take optional from/to local dates. Add gzip=1 for a .gz download.
+    """
+    if dataset not in ('sales', 'inventory', 'customers') or fmt not in FORMATS:
+        return jsonify({"error": "Unknown export"}), 404
+
+    filename = dataset
+    if dataset == 'sales':
+        date_from = request.args.get('from', '').strip()
+        date_to = request.args.get('to', '').strip()
+        match = {}
+        try:
+            if date_from or date_to:
+                match["date"] = {}
+                if date_from:
+                    match["date"]["$gte"] = local_date_to_utc(date_from)
+                if date_to:
+                    match["date"]["$lt"] = local_date_to_utc(date_to) + timedelta(days=1)
+        except ValueError:
+            return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+        if date_from or date_to:
+            filename = f"sales-{date_from or 'start'}-to-{date_to or 'today'}"
+        chunks = encode_rows(sale_rows(db, match), SALE_COLUMNS, fmt)
+    elif dataset == 'inventory':
+        chunks = encode_rows(inventory_rows(db), INVENTORY_COLUMNS, fmt)
+    else:
+        chunks = encode_rows(customer_rows(db), CUSTOMER_COLUMNS, fmt)
+
+    filename = f"{filename}.{fmt}"
+    chunks = stream_with_context(chunks)
+    if request.args.get('gzip') == '1':
+        return Response(gzip_stream(chunks), mimetype='application/gzip',
+                        headers={'Content-Disposition': f'attachment; filename={filename}.gz'})
+    return Response(chunks, mimetype=FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @app.route('/sales/delete/<sale_id>')
 def delete_sale(sale_id):
     try:
@@ -659,21 +970,100 @@ def delete_sale(sale_id):
             flash('Sale not found.', 'danger')
             return redirect(url_for('sales'))
 
-        # Restore stock for each item in the sale
-        for item in sale.get("items", []):
-            med_id = item["medicine_id"]
-            total_units = item["strips"] * (item.get("units_per_strip", 1) or 1) + item["units"]
-            db.medicines.update_one(
-                {"_id": ObjectId(med_id)},
-                {"$inc": {"quantity": total_units}}
-            )
-
-        db.sales.delete_one({"_id": ObjectId(sale_id)})
+        # Delete the sale and restore its stock atomically
+        restored = void_sale(db, client, sale, LOCAL_TIMEZONE)
+        medicine_index.adjust_stock(db, restored)
+        invalidate_invoice(sale_id)
+        invalidate_invoice_pdf(sale_id)
+        dashboard_cache.clear()
         flash('Sale deleted successfully.', 'success')
+    except ReversalConflict as e:
+        flash(str(e), 'danger')
     except Exception as e:
         flash(f'Error deleting sale: {str(e)}', 'danger')
 
     return redirect(url_for('sales'))
 
+@app.route('/sales/<sale_id>/refund', methods=['GET', 'POST'])
+def refund_sale_view(sale_id):
+    try:
+        sale = db.sales.find_one({"_id": ObjectId(sale_id)})
+    except Exception:
+        sale = None
+    if not sale:
+        flash('Sale not found.', 'danger')
+        return redirect(url_for('sales'))
+
+    if request.method == 'POST':
+        try:
+            # refund_units_<line index> holds the units to refund from that line
+            units_by_line = {
+                int(key[len('refund_units_'):]): int(value or 0)
+                for key, value in request.form.items() if key.startswith('refund_units_')
+            }
+            refund, restored = refund_sale(db, client, sale, units_by_line, LOCAL_TIMEZONE, datetime.utcnow())
+            medicine_index.adjust_stock(db, restored)
+            invalidate_invoice(sale_id)
+            invalidate_invoice_pdf(sale_id)
+            dashboard_cache.clear()
+            flash(f"Refunded ₹{refund['amount']:.2f}.", 'success')
+            return redirect(url_for('view_invoice', sale_id=sale_id))
+        except (InvalidRefund, ReversalConflict) as e:
+            flash(str(e), 'danger')
+        except ValueError:
+            flash('Refund quantities must be whole numbers.', 'danger')
+        except Exception as e:
+            app.logger.error(f"Error refunding sale: {e}")
+            flash(f'Error refunding sale: {str(e)}', 'danger')
+        return redirect(url_for('refund_sale_view', sale_id=sale_id))
+
+    lines = [
+        {"index": i, "item": item, "refundable": refundable_units(item)}
+        for i, item in enumerate(sale.get("items", []))
+    ]
+    refunds = list(db.refunds.find({"sale_id": sale["_id"]}).sort("date", ASCENDING))
+    return render_template('sales/refund.html', sale=sale, lines=lines, refunds=refunds)
+
+@app.route('/reports/sales')
+def sales_report():
+    try:
+        days = min(max(int(request.args.get('days', 7)), 1), 366)
+    except ValueError:
+        days = 7
+    report = load_report(db, LOCAL_TIMEZONE, days=days)
+    return render_template('reports/sales.html', days=days, **report)
+
+def demand_params():
+    """(window days, lead time days) from the query string, clamped to sane ranges."""
+    try:
+        days = min(max(int(request.args.get('days', DEMAND_WINDOW_DAYS)), 7), 3 * 366)
+    except ValueError:
+        days = DEMAND_WINDOW_DAYS
+    try:
+        lead_time = min(max(int(request.args.get('lead_time', LEAD_TIME_DAYS)), 1), 90)
+    except ValueError:
+        lead_time = LEAD_TIME_DAYS
+    return days, lead_time
+
+@app.route('/reports/demand')
+def demand_report_page():
+    days, lead_time = demand_params()
+    try:
+        report = demand_report(db, LOCAL_TIMEZONE, days=days, lead_time=lead_time)
+    except Exception as e:
+        app.logger.error(f"Error building demand report: {e}")
+        flash('Failed to build demand report.', 'danger')
+        return redirect(url_for('dashboard'))
+    return render_template('reports/demand.html', **report)
+
+@app.route('/api/reports/demand')
+def demand_report_api():
+    days, lead_time = demand_params()
+    try:
+        return jsonify(demand_report(db, LOCAL_TIMEZONE, days=days, lead_time=lead_time))
+    except Exception as e:
+        app.logger.error(f"Error building demand report: {e}")
+        return jsonify({"error": "Failed to build demand report"}), 500
+
 if __name__ == '__main__':
     app.run(debug=True)
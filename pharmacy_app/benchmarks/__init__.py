@@ -0,0 +1,5 @@
+"""Benchmarks for the pharmacy app. Run from the pharmacy_app directory, e.g.
+
+    python -m benchmarks.customer_search
+    python -m benchmarks.load --mongomock
+"""
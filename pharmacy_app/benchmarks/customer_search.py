@@ -0,0 +1,83 @@
+"""Compare the old regex customer search with the search_keys prefix search.
+
+    python -m benchmarks.customer_search --customers 100000 --queries 500
+
+Seeds a separate database (pharmacy_bench by default) on MONGODB_URI.
+"""
+import argparse
+import os
+import random
+import string
+import time
+
+from pymongo import MongoClient, ASCENDING
+
+from customer_search import customer_search_keys, customer_search_filter
+
+
+FIRST_NAMES = ["ram", "sita", "amit", "priya", "rahul", "sneha", "vijay", "anita", "suresh", "kavita",
+               "deepak", "pooja", "manoj", "neha", "sanjay", "ritu", "ajay", "meena", "arun", "swati"]
+LAST_NAMES = ["patil", "shinde", "ghadge", "kulkarni", "deshmukh", "jadhav", "pawar", "more", "joshi", "kale"]
+
+
+def seed(db, count):
+    db.customers.drop()
+    batch = []
+    for i in range(count):
+        name = f"{random.choice(FIRST_NAMES).title()} {random.choice(LAST_NAMES).title()} {random.choice(string.ascii_uppercase)}"
+        phone = f"9{random.randint(100000000, 999999999)}"
+        batch.append({"name": name, "phone": phone, "search_keys": customer_search_keys(name, phone)})
+        if len(batch) == 5000:
+            db.customers.insert_many(batch)
+            batch = []
+    if batch:
+        db.customers.insert_many(batch)
+    db.customers.create_index([("search_keys", ASCENDING)])
+    db.customers.create_index([("name", ASCENDING)])
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def run(db, queries):
+    projection = {"_id": 1, "name": 1, "phone": 1}
+    timings = {"regex": [], "search_keys": []}
+    for query in queries:
+        regex_filter = {"$or": [{"name": {"$regex": query, "$options": "i"}},
+                                {"phone": {"$regex": query, "$options": "i"}}]}
+        for label, query_filter in (("regex", regex_filter), ("search_keys", customer_search_filter(query))):
+            start = time.perf_counter()
+            list(db.customers.find(query_filter, projection).sort("name", 1).limit(10))
+            timings[label].append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--customers", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--database", default="pharmacy_bench")
+    parser.add_argument("--no-seed", action="store_true", help="reuse customers from a previous run")
+    args = parser.parse_args()
+
+    db = MongoClient(os.environ.get("MONGODB_URI", ""))[args.database]
+    if not args.no_seed:
+        seed(db, args.customers)
+
+    queries = []
+    for _ in range(args.queries):
+        if random.random() < 0.5:
+            queries.append(random.choice(FIRST_NAMES)[:random.randint(2, 4)])
+        else:
+            queries.append(str(random.randint(100, 99999)))
+
+    timings = run(db, queries)
+    for label, samples in timings.items():
+        print(f"{label:12} p50 {percentile(samples, 50):8.2f} ms   p95 {percentile(samples, 95):8.2f} ms   "
+              f"p99 {percentile(samples, 99):8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
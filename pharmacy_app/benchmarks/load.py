@@ -0,0 +1,272 @@
+"""Replay a fixed mix of requests against the app and report latency per route.
+
+    python -m benchmarks.load --requests 200 --json results.json
+    python -m benchmarks.load --mongomock --sales 2000
+
+Seeds synthetic data (see benchmarks.seed) into a separate database on
+MONGODB_URI, or into an in-memory mongomock database with --mongomock or
+when MONGODB_URI is unset, so it also runs offline. Requests go through the
+Flask test client, so the numbers cover routing, queries and template
+rendering but not the network or WSGI server. mongomock timings are only
+comparable with other mongomock runs. mongomock has no $lookup with a
+pipeline and no $type expression, so the harness adds both by wrapping
+mongomock internals; install the pinned version with
+`pip install -r benchmarks/requirements.txt`.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from benchmarks.customer_search import FIRST_NAMES, percentile
+from benchmarks.seed import seed
+
+
+# The patches below replace entries in mongomock's private stage and expression tables
+MONGOMOCK_VERSION = "4.3.0"
+
+SCENARIOS = ["dashboard", "inventory_search", "search_medicines", "search_customers",
+             "checkout", "sales_list", "invoice", "invoice_print", "sales_report",
+             "demand_report"]
+
+
+class _NoTransactionSession:
+    """Stands in for a session on mongomock, which has no transactions."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def with_transaction(self, callback):
+        return callback(None)
+
+
+def _lookup_pipeline_stage(lookup):
+    """Wrap mongomock's $lookup to also run uncorrelated pipelines (no let), as the dashboard's is."""
+
+    def handle(in_collection, database, options):
+        if "pipeline" not in options or "let" in options:
+            return lookup(in_collection, database, options)
+        joined = list(database.get_collection(options["from"]).aggregate(options["pipeline"]))
+        for doc in in_collection:
+            doc[options["as"]] = [dict(match) for match in joined]
+        return in_collection
+
+    return handle
+
+
+_BSON_TYPES = [(bool, "bool"), (int, "int"), (float, "double"), (str, "string"),
+               (datetime, "date"), (dict, "object"), (list, "array"), (type(None), "null")]
+
+
+def _type_expression(handle):
+    """Wrap mongomock's type operators to also evaluate {"$type": <expression>}."""
+
+    def handle_type(parser, operator, values):
+        if operator != "$type":
+            return handle(parser, operator, values)
+        try:
+            value = parser.parse(values)
+        except KeyError:
+            return "missing"
+        return next((name for kind, name in _BSON_TYPES if isinstance(value, kind)), type(value).__name__)
+
+    return handle_type
+
+
+def _mongomock_client():
+    try:
+        import mongomock
+        from mongomock import aggregate
+    except ImportError:
+        sys.exit("--mongomock needs the mongomock package: pip install -r benchmarks/requirements.txt")
+    if mongomock.__version__ != MONGOMOCK_VERSION:
+        sys.exit(f"--mongomock needs mongomock=={MONGOMOCK_VERSION} (found {mongomock.__version__}): "
+                 "pip install -r benchmarks/requirements.txt")
+
+    handlers = aggregate._PIPELINE_HANDLERS
+    if not getattr(handlers["$lookup"], "runs_pipelines", False):
+        handlers["$lookup"] = _lookup_pipeline_stage(handlers["$lookup"])
+        handlers["$lookup"].runs_pipelines = True
+    if "$type" not in aggregate.type_operators:
+        aggregate.type_operators.append("$type")
+        aggregate._Parser._handle_type_operator = _type_expression(aggregate._Parser._handle_type_operator)
+
+    class MongomockClient(mongomock.MongoClient):
+        def start_session(self, **kwargs):
+            return _NoTransactionSession()
+
+    return MongomockClient()
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Workload:
+    """Picks realistic request parameters from the seeded data."""
+
+    def __init__(self, db, rng):
+        self.rng = rng
+        medicines = list(db.medicines.find(
+            {"general": False}, {"name": 1, "quantity": 1, "price_per_strip": 1, "expiry_date": 1}
+        ))
+        now = datetime.utcnow()
+        self.sellable = [m for m in medicines if m.get("quantity", 0) > 100 and m["expiry_date"] > now]
+        self.medicine_names = [m["name"] for m in medicines]
+        self.customers = list(db.customers.find({}, {"_id": 1, "phone": 1}))
+        self.sale_ids = [str(s["_id"]) for s in db.sales.find({}, {"_id": 1}).sort("date", -1).limit(1000)]
+
+    def medicine_prefix(self):
+        return self.rng.choice(self.medicine_names)[:self.rng.randint(2, 5)]
+
+    def customer_query(self):
+        if self.rng.random() < 0.5:
+            return self.rng.choice(FIRST_NAMES)[:self.rng.randint(2, 4)]
+        return self.rng.choice(self.customers)["phone"][-self.rng.randint(3, 5):]
+
+    def checkout_form(self):
+        cart = self.rng.sample(self.sellable, self.rng.randint(1, 3))
+        customer = self.rng.choice(self.customers) if self.rng.random() < 0.7 else None
+        return {
+            "customer_id": str(customer["_id"]) if customer else "",
+            "payment_method": self.rng.choice(["Cash", "UPI", "Card"]),
+            "discount": "0",
+            "names[]": [m["name"] for m in cart],
+            "strips[]": ["0"] * len(cart),
+            "units[]": [str(self.rng.randint(1, 3)) for _ in cart]
+        }
+
+
+def request_for(name, web, workload):
+    """Issue one request of scenario `name`; returns True if the app handled it."""
+    if name == "dashboard":
+        response = web.get("/")
+    elif name == "inventory_search":
+        response = web.get("/inventory", query_string={"search": workload.medicine_prefix()})
+    elif name == "search_medicines":
+        response = web.get("/api/search_medicines", query_string={"query": workload.medicine_prefix()})
+    elif name == "search_customers":
+        response = web.get("/api/search_customers", query_string={"query": workload.customer_query()})
+    elif name == "checkout":
+        response = web.post("/sales/new", data=workload.checkout_form())
+        # A recorded sale redirects to the sales list; stock problems redirect back to the form
+        return response.status_code == 302 and response.location.endswith("/sales")
+    elif name == "sales_list":
+        response = web.get("/sales")
+    elif name == "invoice":
+        response = web.get(f"/sales/{workload.rng.choice(workload.sale_ids)}")
+    elif name == "invoice_print":
+        response = web.get(f"/sales/print/{workload.rng.choice(workload.sale_ids)}")
+    elif name == "sales_report":
+        response = web.get("/reports/sales")
+    elif name == "demand_report":
+        response = web.get("/api/reports/demand", query_string={"days": 365})
+    else:
+        raise ValueError(f"Unknown scenario {name}")
+    return response.status_code < 400
+
+
+def run_scenario(name, web, workload, requests, warmup):
+    for _ in range(warmup):
+        request_for(name, web, workload)
+    timings = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        request_started = time.perf_counter()
+        if not request_for(name, web, workload):
+            errors += 1
+        timings.append((time.perf_counter() - request_started) * 1000)
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "errors": errors,
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p95_ms": round(percentile(timings, 95), 3),
+        "p99_ms": round(percentile(timings, 99), 3),
+        "mean_ms": round(statistics.mean(timings), 3),
+        "throughput_rps": round(requests / elapsed, 1) if elapsed else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongomock", action="store_true", help="use an in-memory database (no server needed)")
+    parser.add_argument("--database", default="pharmacy_bench")
+    parser.add_argument("--medicines", type=int, default=2000)
+    parser.add_argument("--general", type=int, default=200)
+    parser.add_argument("--customers", type=int, default=2000)
+    parser.add_argument("--sales", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42, help="seed for the data and the request mix")
+    parser.add_argument("--no-seed", action="store_true", help="reuse data from a previous run (not with --mongomock)")
+    parser.add_argument("--requests", type=int, default=100, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed requests per scenario")
+    parser.add_argument("--scenario", action="append", dest="scenarios", choices=SCENARIOS,
+                        help="run only these scenarios (repeatable)")
+    parser.add_argument("--json", metavar="PATH", help="write the results to PATH ('-' for stdout)")
+    args = parser.parse_args()
+
+    use_mongomock = args.mongomock or not os.environ.get("MONGODB_URI")
+    os.environ["MONGODB_DB"] = args.database
+    import app as app_module
+    from rollups import rebuild_rollups
+
+    if use_mongomock:
+        mongo = _mongomock_client()
+    else:
+        from pymongo import MongoClient
+        mongo = MongoClient(os.environ["MONGODB_URI"], event_listeners=[app_module.query_tracer])
+    db = mongo[args.database]
+
+    volumes = {"medicines": args.medicines, "general": args.general, "customers": args.customers, "sales": args.sales}
+    if use_mongomock or not args.no_seed:
+        started = time.perf_counter()
+        volumes = seed(db, args.medicines, args.general, args.customers, args.sales, args.seed)
+        rebuild_rollups(db, app_module.LOCAL_TIMEZONE)
+        print(f"Seeded {volumes} in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+
+    # Hand the app our client so it bootstraps indexes and the counter on the seeded data
+    app_module._client = mongo
+    app_module.bootstrap_database(db)
+    web = app_module.app.test_client()
+    workload = Workload(db, random.Random(args.seed))
+
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        results[name] = run_scenario(name, web, workload, args.requests, args.warmup)
+        r = results[name]
+        print(f"{name:18} p50 {r['p50_ms']:8.2f} ms   p95 {r['p95_ms']:8.2f} ms   p99 {r['p99_ms']:8.2f} ms   "
+              f"{r['throughput_rps']:8.1f} req/s   errors {r['errors']}", file=sys.stderr)
+
+    report = {
+        "revision": _git_revision(),
+        "started_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "backend": "mongomock" if use_mongomock else "mongodb",
+        "python": platform.python_version(),
+        "volumes": volumes,
+        "seed": args.seed,
+        "requests_per_scenario": args.requests,
+        "scenarios": results
+    }
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
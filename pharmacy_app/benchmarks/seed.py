@@ -0,0 +1,176 @@
+"""Deterministic synthetic pharmacy data for the benchmarks.
+
+    python -m benchmarks.seed --medicines 5000 --customers 20000 --sales 50000
+
+Drops and refills the medicines, customers, sales, counters and rollup
+collections of a separate database (pharmacy_bench by default) on
+MONGODB_URI. The same --seed always produces the same data.
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient
+
+from customer_search import customer_search_keys
+from sale_snapshots import item_snapshot
+from watchlist import watch_fields
+from benchmarks.customer_search import FIRST_NAMES, LAST_NAMES
+
+
+NAME_STEMS = ["para", "amoxi", "azithro", "cetiri", "metfor", "panto", "ome", "ator", "losar", "amlo",
+              "dolo", "levo", "cipro", "diclo", "ibu", "monte", "rabe", "telmi", "glime", "vita"]
+NAME_ENDINGS = ["cet", "cillin", "mycin", "zine", "min", "prazole", "vastatin", "tan", "dipine", "fen",
+                "floxacin", "lukast", "sartan", "pride", "plex"]
+STRENGTHS = ["50", "100", "250", "500", "650", "5", "10", "20", "40"]
+COMPANIES = ["Cipla", "Sun Pharma", "Lupin", "Mankind", "Alkem", "Zydus", "Torrent", "Glenmark"]
+SUPPLIERS = ["Nashik Pharma Distributors", "Shree Medical Agency", "Om Sai Traders", "Ganesh Medico"]
+GENERAL_ITEMS = ["Cotton Roll", "Face Mask", "Hand Sanitizer", "Bandage", "Thermometer", "Glucose Powder",
+                 "Baby Wipes", "ORS Sachet", "Crepe Bandage", "Syringe"]
+PAYMENT_METHODS = ["Cash", "UPI", "Card"]
+
+COLLECTIONS = ["medicines", "customers", "sales", "counters", "sales_daily_rollup",
+               "refunds", "stock_movements", "stock_snapshots"]
+BATCH_SIZE = 5000
+
+
+def _insert(collection, docs):
+    for start in range(0, len(docs), BATCH_SIZE):
+        collection.insert_many(docs[start:start + BATCH_SIZE], ordered=False)
+
+
+def make_medicines(rng, count, now):
+    medicines = []
+    for i in range(count):
+        units_per_strip = rng.choice([6, 10, 10, 15])
+        price_per_strip = round(rng.uniform(20, 400), 2)
+        price_per_unit = round(price_per_strip / units_per_strip, 2)
+        mfg_date = now - timedelta(days=rng.randint(30, 700))
+        medicines.append({
+            "name": f"{rng.choice(NAME_STEMS).title()}{rng.choice(NAME_ENDINGS)} {rng.choice(STRENGTHS)}",
+            "batch_number": f"B{i:07d}",
+            "supplier": rng.choice(SUPPLIERS),
+            "company": rng.choice(COMPANIES),
+            "mfg_date": mfg_date,
+            # Mostly in date, some expiring soon and a few already expired
+            "expiry_date": now + timedelta(days=rng.randint(-60, 900)),
+            "units_per_strip": units_per_strip,
+            "price_per_strip": price_per_strip,
+            "price_per_unit": price_per_unit,
+            "quantity": rng.choice([0, 3, 8]) if rng.random() < 0.1 else rng.randint(20, 2000) * units_per_strip,
+            "cost_price": round(price_per_strip * 0.7, 2),
+            "cost_price_per_unit": round(price_per_unit * 0.7, 2),
+            "created_at": mfg_date,
+            "general": False
+        })
+    return medicines
+
+
+def make_general(rng, count, now, offset):
+    items = []
+    for i in range(count):
+        items.append({
+            "name": f"{rng.choice(GENERAL_ITEMS)} {rng.choice(['S', 'M', 'L', 'XL'])}",
+            "batch_number": f"G{offset + i:07d}",
+            "quantity": rng.randint(0, 300),
+            "price": round(rng.uniform(10, 500), 2),
+            "supplier": rng.choice(SUPPLIERS),
+            "company": rng.choice(COMPANIES),
+            "mfg_date": now - timedelta(days=rng.randint(30, 700)),
+            "expiry_date": now + timedelta(days=rng.randint(-30, 1500)),
+            "created_at": now - timedelta(days=rng.randint(0, 365)),
+            "general": True
+        })
+    return items
+
+
+def make_customers(rng, count):
+    customers = []
+    for _ in range(count):
+        name = f"{rng.choice(FIRST_NAMES).title()} {rng.choice(LAST_NAMES).title()}"
+        phone = f"9{rng.randint(100000000, 999999999)}"
+        customers.append({
+            "name": name,
+            "phone": phone,
+            "address": f"{rng.randint(1, 200)}, Nashik Road, Nashik",
+            "search_keys": customer_search_keys(name, phone)
+        })
+    return customers
+
+
+def make_sales(rng, count, medicines, customer_ids, now, days=365, max_items=5, first_invoice=1001):
+    """Sales spread over the last `days` days, shaped like the documents new_sale() writes."""
+    sales = []
+    for i in range(count):
+        items = []
+        total_amount = 0
+        for med in rng.sample(medicines, rng.randint(1, max_items)):
+            strips = rng.randint(0, 2)
+            units = rng.randint(0 if strips else 1, med["units_per_strip"] - 1)
+            total_units = strips * med["units_per_strip"] + units
+            line_total = strips * med["price_per_strip"] + units * med["price_per_unit"]
+            total_amount += line_total
+            items.append({
+                "medicine_id": med["_id"],
+                **item_snapshot(med),
+                "strips": strips,
+                "units": units,
+                "total_units": total_units,
+                "price": med["price_per_strip"],
+                "total": line_total,
+                "cost": total_units * med["cost_price_per_unit"]
+            })
+        discount = rng.choice([0, 0, 0, 5, 10])
+        sales.append({
+            "invoice_number": first_invoice + i,
+            "customer_id": rng.choice(customer_ids) if customer_ids and rng.random() < 0.7 else None,
+            "payment_method": rng.choice(PAYMENT_METHODS),
+            "discount": discount,
+            "total_amount": total_amount - discount,
+            "items": items,
+            "date": now - timedelta(seconds=rng.randint(0, days * 86400))
+        })
+    return sales
+
+
+def seed(db, medicines=2000, general=200, customers=2000, sales=5000, seed=42, now=None):
+    """Replace the benchmark collections of `db` with synthetic data.
+
+    Returns the counts inserted. Indexes, the invoice counter and the daily
+    rollups are left to the app's own bootstrap and rebuild-rollups.
+    """
+    rng = random.Random(seed)
+    now = now or datetime.utcnow()
+    for name in COLLECTIONS:
+        db[name].drop()
+
+    medicine_docs = make_medicines(rng, medicines, now)
+    catalog = medicine_docs + make_general(rng, general, now, offset=medicines)
+    for doc in catalog:
+        doc.update(watch_fields(doc, now))
+    _insert(db.medicines, catalog)
+    customer_docs = make_customers(rng, customers)
+    _insert(db.customers, customer_docs)
+    sale_docs = make_sales(rng, sales, medicine_docs, [c["_id"] for c in customer_docs], now)
+    _insert(db.sales, sale_docs)
+    return {"medicines": medicines, "general": general, "customers": customers, "sales": sales}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--medicines", type=int, default=2000)
+    parser.add_argument("--general", type=int, default=200)
+    parser.add_argument("--customers", type=int, default=2000)
+    parser.add_argument("--sales", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database", default="pharmacy_bench")
+    args = parser.parse_args()
+
+    db = MongoClient(os.environ.get("MONGODB_URI", ""))[args.database]
+    counts = seed(db, args.medicines, args.general, args.customers, args.sales, args.seed)
+    print(", ".join(f"{count} {name}" for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Measure cold-start cost: importing app.py and serving the first requests.
+
+    python -m benchmarks.startup --runs 5 --path / --path /api/search_medicines?query=pa
+
+Each run happens in a fresh interpreter, as on a new serverless container.
+Use --max-import-ms to fail (exit 1) when the import time regresses.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child interpreter; prints one JSON line
+PROBE = r"""
+import json, sys, time
+started = time.perf_counter()
+import app as app_module
+import_ms = (time.perf_counter() - started) * 1000
+client = app_module.app.test_client()
+requests = []
+for path in sys.argv[1:]:
+    started = time.perf_counter()
+    status = client.get(path).status_code
+    requests.append({"path": path, "status": status, "ms": (time.perf_counter() - started) * 1000})
+print(json.dumps({"import_ms": import_ms, "requests": requests,
+                  "reportlab_loaded": "reportlab" in sys.modules}))
+"""
+
+
+def run_once(paths):
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE, *paths],
+        cwd=APP_DIR, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", action="append", dest="paths", help="request to time after import (repeatable)")
+    parser.add_argument("--max-import-ms", type=float, help="exit 1 if the median import time exceeds this")
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    args = parser.parse_args()
+    paths = args.paths or ["/"]
+
+    runs = [run_once(paths) for _ in range(args.runs)]
+    import_ms = statistics.median(r["import_ms"] for r in runs)
+    summary = {
+        "import_ms": import_ms,
+        "first_request_ms": {
+            path: statistics.median(r["requests"][i]["ms"] for r in runs) for i, path in enumerate(paths)
+        },
+        "reportlab_loaded": any(r["reportlab_loaded"] for r in runs),
+        "runs": runs if args.json else len(runs),
+    }
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"import           {import_ms:8.1f} ms (median of {len(runs)})")
+        for path, ms in summary["first_request_ms"].items():
+            print(f"first GET {path:30} {ms:8.1f} ms")
+        print(f"ReportLab loaded after these requests: {summary['reportlab_loaded']}")
+
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print(f"Import time {import_ms:.1f} ms exceeds {args.max_import_ms:.1f} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
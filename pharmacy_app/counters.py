@@ -0,0 +1,80 @@
+import threading
+
+from pymongo import ReturnDocument, DESCENDING
+
+
+INVOICE_COUNTER = "invoice_number"
+FIRST_INVOICE_NUMBER = 1001
+
+
+class InvoiceNumberAllocator:
+    """Hands out invoice numbers from the `counters` collection.
+
+    With block_size > 1 each process reserves a block of numbers in one
+    round trip and serves them from memory. Numbers stay unique across
+    processes, but a block left unused when a process exits becomes a gap.
+    Numbers are also taken before the sale is written, outside its
+    transaction, so a sale that fails (e.g. InsufficientStock) leaves a gap
+    too: invoice numbers are unique and increasing, not gapless.
+
+    If the counter does not exist yet it is seeded from the sales on first
+    use (see seed_invoice_counter), never restarted from zero.
+    """
+
+    def __init__(self, db, block_size=1):
+        self.db = db
+        self.block_size = max(1, int(block_size))
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def next_number(self):
+        with self._lock:
+            if self._next >= self._end:
+                self._end = self._advance(self.block_size) + 1
+                self._next = self._end - self.block_size
+            number = self._next
+            self._next += 1
+            return number
+
+    def reserve(self, count):
+        """`count` consecutive numbers in one round trip, outside the per-process block."""
+        if count <= 0:
+            return []
+        seq = self._advance(count)
+        return list(range(seq - count + 1, seq + 1))
+
+    def _advance(self, count):
+        """Add count to the counter and return its new value."""
+        for _ in range(2):
+            counter = self.db.counters.find_one_and_update(
+                {"_id": INVOICE_COUNTER},
+                {"$inc": {"seq": count}},
+                return_document=ReturnDocument.AFTER
+            )
+            if counter is not None:
+                return counter["seq"]
+            seed_invoice_counter(self.db)
+        raise RuntimeError("Invoice counter could not be seeded.")
+
+
+def seed_invoice_counter(db):
+    """Make sure the counter is at least the highest invoice number already used.
+
+    Uses $max, so running it again (or after new sales) never moves the
+    counter backwards. Returns the counter value.
+    """
+    last_sale = db.sales.find_one(
+        {"invoice_number": {"$exists": True}},
+        {"invoice_number": 1},
+        sort=[("invoice_number", DESCENDING)]
+    )
+    current_max = last_sale["invoice_number"] if last_sale else FIRST_INVOICE_NUMBER - 1
+    counter = db.counters.find_one_and_update(
+        {"_id": INVOICE_COUNTER},
+        {"$max": {"seq": current_max}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
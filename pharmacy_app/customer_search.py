@@ -0,0 +1,56 @@
+import re
+
+from pymongo import UpdateOne
+
+
+PHONE_QUERY = re.compile(r'^[\d\s+\-()]+$')
+
+
+def phone_digits(phone):
+    return re.sub(r'\D', '', phone or '')
+
+
+def customer_search_keys(name, phone):
+    """Normalized keys stored on each customer for prefix search.
+
+    Lowercased name tokens plus every suffix of the digits-only phone, so a
+    prefix match on the keys finds any run of digits inside the number.
+    """
+    keys = set((name or '').lower().split())
+    digits = phone_digits(phone)
+    keys.update(digits[i:] for i in range(len(digits)))
+    return sorted(keys)
+
+
+def customer_search_filter(query):
+    """Anchored, index-backed filter on search_keys for a search box query.
+
+    Customers stored before search_keys existed (and not yet backfilled) are
+    matched on name and phone as before; that branch reads only them,
+    through the (search_keys) index.
+    """
+    if PHONE_QUERY.match(query) and phone_digits(query):
+        terms = [phone_digits(query)]
+    else:
+        terms = query.lower().split()
+    conditions = [{"search_keys": re.compile('^' + re.escape(term))} for term in terms]
+    legacy = {"search_keys": {"$exists": False}, "$or": [
+        {"name": {"$regex": re.escape(query), "$options": "i"}},
+        {"phone": {"$regex": re.escape(query), "$options": "i"}}
+    ]}
+    return {"$or": [conditions[0] if len(conditions) == 1 else {"$and": conditions}, legacy]}
+
+
+def backfill_customer_search_keys(db, batch_size=1000):
+    """Store search_keys on customers written before they existed. Returns the count updated."""
+    updated = 0
+    ops = []
+    for customer in db.customers.find({"search_keys": {"$exists": False}}, {"name": 1, "phone": 1}).batch_size(batch_size):
+        keys = customer_search_keys(customer.get("name"), customer.get("phone"))
+        ops.append(UpdateOne({"_id": customer["_id"]}, {"$set": {"search_keys": keys}}))
+        if len(ops) == batch_size:
+            updated += db.customers.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += db.customers.bulk_write(ops, ordered=False).modified_count
+    return updated
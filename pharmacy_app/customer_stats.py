@@ -0,0 +1,81 @@
+from pymongo import UpdateOne, DESCENDING
+
+
+# Lifetime aggregates kept on each customer document:
+#   stats: {spend, visits, last_visit}
+# The average basket is derived on read as spend / visits. Spend is net of
+# partial refunds (refunded_amount on the sale, see refunds.py).
+
+
+def customer_stats_update(sale, sign=1):
+    """UpdateOne adding (sign=1) or removing (sign=-1) a sale from its customer's stats,
+    or None for walk-in sales."""
+    customer_id = sale.get("customer_id")
+    if not customer_id:
+        return None
+    spend = float(sale.get("total_amount", 0) or 0) - float(sale.get("refunded_amount", 0) or 0)
+    update = {"$inc": {"stats.spend": sign * spend, "stats.visits": sign}}
+    if sign > 0:
+        update["$max"] = {"stats.last_visit": sale["date"]}
+    return UpdateOne({"_id": customer_id}, update)
+
+
+def apply_customer_stats(db, sale, sign=1, session=None):
+    """Update the customer's stats for a sale just recorded or (sign=-1) just deleted.
+
+    When a sale is removed the last visit falls back to the customer's most
+    recent remaining sale, so call this after the sale itself is deleted.
+    """
+    op = customer_stats_update(sale, sign)
+    if op is None:
+        return
+    ops = [op]
+    if sign < 0:
+        latest = db.sales.find_one({"customer_id": sale["customer_id"]}, {"date": 1},
+                                   sort=[("date", DESCENDING), ("_id", DESCENDING)], session=session)
+        ops.append(UpdateOne({"_id": sale["customer_id"]},
+                             {"$set": {"stats.last_visit": latest["date"] if latest else None}}))
+    db.customers.bulk_write(ops, session=session)
+
+
+def profile_stats(customer):
+    """Display values for the profile page, tolerating customers without stats yet."""
+    stats = customer.get("stats") or {}
+    spend = stats.get("spend", 0) or 0
+    visits = stats.get("visits", 0) or 0
+    return {
+        "spend": spend,
+        "visits": visits,
+        "last_visit": stats.get("last_visit"),
+        "average_basket": spend / visits if visits else 0
+    }
+
+
+def backfill_customer_stats(db, batch_size=1000):
+    """Recompute every customer's stats from their sales. Returns the number of customers with sales.
+
+    Stats are reset first and then filled in from one grouped pass over the
+    sales, so run it while the tills are idle.
+    """
+    db.customers.update_many({}, {"$set": {"stats": {"spend": 0, "visits": 0, "last_visit": None}}})
+    updated = 0
+    ops = []
+    grouped = db.sales.aggregate([
+        {"$match": {"customer_id": {"$ne": None}}},
+        {"$group": {
+            "_id": "$customer_id",
+            "spend": {"$sum": {"$subtract": ["$total_amount", {"$ifNull": ["$refunded_amount", 0]}]}},
+            "visits": {"$sum": 1},
+            "last_visit": {"$max": "$date"}
+        }}
+    ], allowDiskUse=True, batchSize=batch_size)
+    for group in grouped:
+        ops.append(UpdateOne({"_id": group["_id"]}, {"$set": {"stats": {
+            "spend": group["spend"], "visits": group["visits"], "last_visit": group["last_visit"]
+        }}}))
+        if len(ops) == batch_size:
+            updated += db.customers.bulk_write(ops, ordered=False).matched_count
+            ops = []
+    if ops:
+        updated += db.customers.bulk_write(ops, ordered=False).matched_count
+    return updated
@@ -0,0 +1,91 @@
+import os
+from datetime import datetime
+
+from cache import TTLCache
+
+
+EXPIRY_ALERT_LIMIT = 100
+LOW_STOCK_LIMIT = 50
+RECENT_SALES_LIMIT = 5
+
+# The summary is shared by every dashboard view for a few seconds and
+# cleared on inventory and sales writes
+dashboard_cache = TTLCache(maxsize=1, ttl=int(os.environ.get("DASHBOARD_CACHE_SECONDS", 5)))
+
+
+def load_dashboard(db, now):
+    """Compute all three dashboard panels in a single aggregation.
+
+    The alerts come from the watch fields maintained by the write paths (see
+    watchlist.py), so the leading $match is two index lookups: the expiry
+    queue up to now and the batches flagged low on stock, whatever their
+    individual thresholds. $facet then splits the matches into the two alert
+    panels and always emits one document, onto which the recent sales are joined.
+    """
+    pipeline = [
+        {"$match": {"$or": [
+            {"expiry_alert_at": {"$lte": now}},
+            {"low_stock": True}
+        ]}},
+        {"$facet": {
+            "expiring_meds": [
+                {"$match": {"expiry_alert_at": {"$lte": now}}},
+                {"$sort": {"expiry_alert_at": 1}},
+                {"$limit": EXPIRY_ALERT_LIMIT},
+                {"$project": {"name": 1, "batch_number": 1, "company": 1, "supplier": 1, "expiry_date": 1}}
+            ],
+            "low_stock": [
+                {"$match": {"low_stock": True}},
+                {"$sort": {"quantity": 1}},
+                {"$limit": LOW_STOCK_LIMIT},
+                {"$project": {"name": 1, "quantity": 1, "price": 1, "price_per_unit": 1}}
+            ]
+        }},
+        {"$lookup": {
+            "from": "sales",
+            "pipeline": [
+                {"$sort": {"date": -1}},
+                {"$limit": RECENT_SALES_LIMIT},
+                {"$lookup": {
+                    "from": "customers",
+                    "localField": "customer_id",
+                    "foreignField": "_id",
+                    "as": "customer"
+                }},
+                {"$project": {
+                    "invoice_number": 1,
+                    "date": 1,
+                    "total_amount": 1,
+                    "customer_name": {"$ifNull": [{"$arrayElemAt": ["$customer.name", 0]}, "Walk-in"]}
+                }}
+            ],
+            "as": "recent_sales"
+        }}
+    ]
+    result = next(db.medicines.aggregate(pipeline), None) or {}
+
+    expiring_meds = result.get("expiring_meds", [])
+    for med in expiring_meds:
+        med['expiry_date'] = med['expiry_date'].strftime('%Y-%m-%d') if isinstance(med['expiry_date'], datetime) else med['expiry_date']
+
+    recent_sales = result.get("recent_sales", [])
+    for sale in recent_sales:
+        sale['invoice_number'] = sale.get('invoice_number', str(sale['_id'])[-6:])  # fallback if invoice_number not set
+        sale['date'] = sale['date'] if isinstance(sale['date'], datetime) else datetime.fromtimestamp(sale['date'] / 1000)
+        sale['total_amount'] = float(sale['total_amount'])
+
+    return {
+        "expiring_meds": expiring_meds,
+        "low_stock": result.get("low_stock", []),
+        "recent_sales": recent_sales
+    }
+
+
+def get_dashboard(db, now):
+    """Return (summary, cache_hit), using the short-lived cache when possible."""
+    summary = dashboard_cache.get("summary")
+    if summary is not None:
+        return summary, True
+    summary = load_dashboard(db, now)
+    dashboard_cache.set("summary", summary)
+    return summary, False
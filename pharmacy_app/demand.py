@@ -0,0 +1,183 @@
+import math
+import os
+from datetime import datetime, time, timedelta
+
+import pytz
+from pymongo import DESCENDING
+
+from cache import TTLCache
+
+
+DEMAND_WINDOW_DAYS = 90
+LEAD_TIME_DAYS = int(os.environ.get("REORDER_LEAD_TIME_DAYS", 7))
+# Safety stock covers ~95% of lead times (one-sided normal quantile)
+SERVICE_LEVEL_Z = 1.65
+RECENT_DAYS = 7
+LINE_BATCH_SIZE = 10000
+
+# Sales-derived arrays keyed by (sales_token, window start, days). Stock and
+# cost are joined on every request, so only new, deleted or refunded sales
+# invalidate an entry; the TTL just bounds memory for idle windows.
+demand_cache = TTLCache(maxsize=16, ttl=24 * 3600)
+
+
+def sales_token(db):
+    """Changes whenever a sale is added, deleted or refunded; three indexed lookups."""
+    latest_sale = db.sales.find_one({}, {"_id": 1}, sort=[("_id", DESCENDING)])
+    latest_refund = db.refunds.find_one({}, {"_id": 1}, sort=[("_id", DESCENDING)])
+    return (
+        latest_sale["_id"] if latest_sale else None,
+        db.sales.estimated_document_count(),
+        latest_refund["_id"] if latest_refund else None
+    )
+
+
+def load_lines(db, start, batch_size=LINE_BATCH_SIZE):
+    """Columns of every sale line since `start`: (names, name codes, day offsets, net units, net revenue).
+
+    Each line's name is coded as its position in names; lines recorded
+    before item snapshots are named from their batch with one more query.
+    The day offset from `start` is computed by the server.
+    """
+    cursor = db.sales.aggregate([
+        {"$match": {"date": {"$gte": start}}},
+        {"$project": {"date": 1, "items.medicine_id": 1, "items.name": 1, "items.total_units": 1,
+                      "items.refunded_units": 1, "items.total": 1, "items.refunded_total": 1}},
+        {"$unwind": "$items"},
+        {"$project": {
+            "_id": 0,
+            "d": {"$floor": {"$divide": [{"$subtract": ["$date", start]}, 86400000]}},
+            "m": "$items.medicine_id",
+            "n": "$items.name",
+            "u": {"$subtract": [{"$ifNull": ["$items.total_units", 0]}, {"$ifNull": ["$items.refunded_units", 0]}]},
+            "r": {"$subtract": [{"$ifNull": ["$items.total", 0]}, {"$ifNull": ["$items.refunded_total", 0]}]}
+        }}
+    ], batchSize=batch_size)
+    codes_by_name = {}
+    codes, days, units, revenue = [], [], [], []
+    unnamed = []
+
+    def add(name, line):
+        codes.append(codes_by_name.setdefault(name, len(codes_by_name)))
+        days.append(line["d"])
+        units.append(line["u"])
+        revenue.append(line["r"])
+
+    for line in cursor:
+        if line.get("n"):
+            add(line["n"], line)
+        elif line.get("m"):
+            unnamed.append(line)
+    if unnamed:
+        id_names = {med["_id"]: med.get("name") for med in db.medicines.find(
+            {"_id": {"$in": list({line["m"] for line in unnamed})}}, {"name": 1})}
+        for line in unnamed:
+            if id_names.get(line["m"]):
+                add(id_names[line["m"]], line)
+    return list(codes_by_name), codes, days, units, revenue
+
+
+def sales_stats(names, codes, day, units, revenue, days):
+    """Per-medicine demand arrays from load_lines() columns, without a per-line Python loop."""
+    # NumPy is imported here so that only demand reports pay for it at startup
+    import numpy as np
+    n = len(names)
+    codes = np.asarray(codes, dtype=np.int64)
+    day = np.clip(np.asarray(day, dtype=np.int64), 0, days - 1)
+    units = np.asarray(units, dtype=float)
+    revenue = np.asarray(revenue, dtype=float)
+
+    total_units = np.bincount(codes, weights=units, minlength=n)
+    total_revenue = np.bincount(codes, weights=revenue, minlength=n)
+    recent = day >= days - RECENT_DAYS
+    recent_units = np.bincount(codes[recent], weights=units[recent], minlength=n)
+
+    # Units per (medicine, day) for the spread of daily demand; days without sales count as zero
+    cells, cell_index = np.unique(codes * days + day, return_inverse=True)
+    daily = np.bincount(cell_index.ravel(), weights=units)
+    sum_sq = np.bincount(cells // days, weights=daily ** 2, minlength=n)
+    velocity = total_units / days
+    return {
+        "names": names,
+        "units": total_units,
+        "revenue": total_revenue,
+        "velocity": velocity,
+        "recent_velocity": recent_units / min(RECENT_DAYS, days),
+        "std": np.sqrt(np.maximum(sum_sq / days - velocity ** 2, 0))
+    }
+
+
+def load_catalog(db, names):
+    """{name: (sellable units, quantity-weighted cost per unit)} for the medicines sold in the window."""
+    totals = {}
+    for med in db.medicines.find({"name": {"$in": list(names)}},
+                                 {"name": 1, "quantity": 1, "cost_price_per_unit": 1, "expired": 1}) \
+            .batch_size(LINE_BATCH_SIZE):
+        quantity = 0 if med.get("expired") else max(med.get("quantity") or 0, 0)
+        cost = float(med.get("cost_price_per_unit") or 0)
+        t = totals.setdefault(med["name"], [0, 0.0, 0.0, 0])
+        t[0] += quantity
+        t[1] += quantity * cost
+        t[2] += cost
+        t[3] += 1
+    return {
+        name: (t[0], t[1] / t[0] if t[0] else t[2] / t[3])
+        for name, t in totals.items()
+    }
+
+
+def _number(value, digits=2):
+    value = float(value)
+    return None if math.isnan(value) or math.isinf(value) else round(value, digits)
+
+
+def demand_report(db, tz, days=DEMAND_WINDOW_DAYS, lead_time=LEAD_TIME_DAYS, now=None):
+    """Velocity, days of cover, margin and reorder point for every medicine sold in the last `days` local days.
+
+    velocity         units per day over the window (recent_velocity: last 7 days)
+    days_of_cover    sellable stock / velocity
+    margin           (average selling price - cost per unit) / selling price
+    reorder_point    velocity * lead_time + Z * daily std * sqrt(lead_time)
+    Rows are ordered by days of cover, then velocity.
+    """
+    import numpy as np
+    now = now or datetime.utcnow()
+    # Days run midnight to midnight in tz, as in the sales rollups
+    first_day = pytz.utc.localize(now).astimezone(tz).date() - timedelta(days=days - 1)
+    start = tz.localize(datetime.combine(first_day, time())).astimezone(pytz.utc).replace(tzinfo=None)
+
+    key = (sales_token(db), start, days)
+    stats = demand_cache.get(key)
+    if stats is None:
+        stats = sales_stats(*load_lines(db, start), days)
+        demand_cache.set(key, stats)
+
+    names = stats["names"]
+    catalog = load_catalog(db, names)
+    stock = np.array([catalog.get(name, (0, 0.0))[0] for name in names], dtype=float)
+    cost = np.array([catalog.get(name, (0, 0.0))[1] for name in names], dtype=float)
+    velocity = stats["velocity"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cover = np.where(velocity > 0, stock / velocity, np.inf)
+        price = np.where(stats["units"] > 0, stats["revenue"] / stats["units"], 0)
+        margin = np.where(price > 0, (price - cost) / price, np.nan)
+        trend = np.where(velocity > 0, stats["recent_velocity"] / velocity, np.nan)
+    reorder_point = velocity * lead_time + SERVICE_LEVEL_Z * stats["std"] * math.sqrt(lead_time)
+    reorder = stock <= reorder_point
+
+    order = np.lexsort((-velocity, cover))
+    medicines = [{
+        "name": names[i],
+        "stock": int(stock[i]),
+        "units_sold": _number(stats["units"][i]),
+        "velocity": _number(velocity[i]),
+        "recent_velocity": _number(stats["recent_velocity"][i]),
+        "trend": _number(trend[i]),
+        "days_of_cover": _number(cover[i], 1),
+        "avg_price": _number(price[i]),
+        "cost_per_unit": _number(cost[i]),
+        "margin": _number(margin[i], 4),
+        "reorder_point": int(math.ceil(reorder_point[i])),
+        "reorder": bool(reorder[i])
+    } for i in order]
+    return {"days": days, "lead_time": lead_time, "start": first_day, "medicines": medicines}
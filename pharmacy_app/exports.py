@@ -0,0 +1,161 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+
+from sale_snapshots import unsnapshotted_ids
+
+
+# Documents fetched per cursor round trip; rows are also flushed to the
+# response in blocks of this many so each chunk is a few hundred KB at most.
+EXPORT_BATCH_SIZE = 1000
+
+SALE_COLUMNS = [
+    "invoice_number", "date", "sale_id", "customer_name", "customer_phone", "payment_method",
+    "discount", "total_amount", "line", "medicine_id", "medicine_name", "batch_number",
+    "strips", "units", "total_units", "price_per_strip", "price_per_unit", "line_total", "cost",
+    "refunded_units"
+]
+INVENTORY_COLUMNS = [
+    "_id", "name", "batch_number", "general", "quantity", "units_per_strip", "price_per_strip",
+    "price_per_unit", "price", "cost_price_per_unit", "supplier", "company", "mfg_date",
+    "expiry_date", "expired", "low_stock"
+]
+CUSTOMER_COLUMNS = ["_id", "name", "phone", "address", "spend", "visits", "last_visit"]
+
+SALE_FIELDS = {
+    "invoice_number": 1, "date": 1, "customer_id": 1, "payment_method": 1,
+    "discount": 1, "total_amount": 1, "items": 1
+}
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def _value(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _batched(cursor, size):
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def sale_rows(db, match, batch_size=EXPORT_BATCH_SIZE):
+    """One row per sale line item, oldest sale first.
+
+    Sales are read from one cursor over the (date, _id) index. Customers are
+    looked up once per batch of sales with an $in query, as are medicines
+    for lines recorded before item snapshots.
+    """
+    cursor = db.sales.find(match, SALE_FIELDS).sort(
+        [("date", ASCENDING), ("_id", ASCENDING)]).batch_size(batch_size)
+    for sales in _batched(cursor, batch_size):
+        customer_ids = {sale["customer_id"] for sale in sales if sale.get("customer_id")}
+        medicine_ids = unsnapshotted_ids(sales)
+        customers = {c["_id"]: c for c in db.customers.find(
+            {"_id": {"$in": list(customer_ids)}}, {"name": 1, "phone": 1})} if customer_ids else {}
+        medicines = {m["_id"]: m for m in db.medicines.find(
+            {"_id": {"$in": list(medicine_ids)}},
+            {"name": 1, "batch_number": 1, "price_per_strip": 1, "price_per_unit": 1})} if medicine_ids else {}
+
+        for sale in sales:
+            customer = customers.get(sale.get("customer_id"), {})
+            for line, item in enumerate(sale.get("items", []), start=1):
+                med = item if "name" in item else medicines.get(item["medicine_id"], {})
+                yield {
+                    "invoice_number": sale.get("invoice_number"),
+                    "date": sale.get("date"),
+                    "sale_id": sale["_id"],
+                    "customer_name": customer.get("name", "Walk-in Customer"),
+                    "customer_phone": customer.get("phone", ""),
+                    "payment_method": sale.get("payment_method"),
+                    "discount": sale.get("discount", 0),
+                    "total_amount": sale.get("total_amount"),
+                    "line": line,
+                    "medicine_id": item["medicine_id"],
+                    "medicine_name": med.get("name", ""),
+                    "batch_number": med.get("batch_number", ""),
+                    "strips": item.get("strips", 0),
+                    "units": item.get("units", 0),
+                    "total_units": item.get("total_units"),
+                    "price_per_strip": med.get("price_per_strip"),
+                    "price_per_unit": med.get("price_per_unit"),
+                    "line_total": item.get("total"),
+                    "cost": item.get("cost"),
+                    "refunded_units": item.get("refunded_units", 0),
+                }
+
+
+def inventory_rows(db, batch_size=EXPORT_BATCH_SIZE):
+    """Every medicine and general item, in (general, name, _id) index order."""
+    projection = {column: 1 for column in INVENTORY_COLUMNS}
+    cursor = db.medicines.find({}, projection).sort(
+        [("general", ASCENDING), ("name", ASCENDING), ("_id", ASCENDING)]).batch_size(batch_size)
+    for med in cursor:
+        yield {column: med.get(column) for column in INVENTORY_COLUMNS}
+
+
+def customer_rows(db, batch_size=EXPORT_BATCH_SIZE):
+    """Every customer with their stored lifetime stats, in name order."""
+    cursor = db.customers.find({}, {"name": 1, "phone": 1, "address": 1, "stats": 1}).sort(
+        [("name", ASCENDING), ("_id", ASCENDING)]).batch_size(batch_size)
+    for customer in cursor:
+        stats = customer.get("stats") or {}
+        yield {
+            "_id": customer["_id"],
+            "name": customer.get("name", ""),
+            "phone": customer.get("phone", ""),
+            "address": customer.get("address", ""),
+            "spend": stats.get("spend", 0),
+            "visits": stats.get("visits", 0),
+            "last_visit": stats.get("last_visit"),
+        }
+
+
+def encode_rows(rows, columns, fmt, block_size=EXPORT_BATCH_SIZE):
+    """Serialize rows as CSV (with a header line) or NDJSON, yielding text blocks."""
+    buffer = io.StringIO()
+    if fmt == "csv":
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = lambda row: writer.writerow(["" if row[c] is None else _value(row[c]) for c in columns])
+    else:
+        write = lambda row: buffer.write(json.dumps({c: _value(row[c]) for c in columns}) + "\n")
+
+    count = 0
+    for row in rows:
+        write(row)
+        count += 1
+        if count % block_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_stream(chunks):
+    """Compress a stream of text blocks into gzip bytes as it goes."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,140 @@
+from datetime import datetime
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from bson.objectid import ObjectId
+
+from customer_search import customer_search_filter
+
+
+# Indexes each route relies on, grouped by collection.
+INDEXES = {
+    "medicines": [
+        # add_medicine() duplicate batch check
+        IndexModel([("batch_number", ASCENDING)], unique=True),
+        # inventory() / general_inventory() keyset pages sorted by name, expiry or quantity
+        IndexModel([("general", ASCENDING), ("name", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("general", ASCENDING), ("expiry_date", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("general", ASCENDING), ("quantity", ASCENDING), ("_id", ASCENDING)]),
+        # new_sale() FEFO allocation: every batch of the requested names by expiry;
+        # demand_report() stock of the names sold
+        IndexModel([("name", ASCENDING), ("expiry_date", ASCENDING), ("_id", ASCENDING)]),
+        # dashboard() expiry alerts: the expiry queue (see watchlist.py)
+        IndexModel([("expiry_alert_at", ASCENDING)]),
+        # dashboard() low stock alerts
+        IndexModel([("low_stock", ASCENDING), ("quantity", ASCENDING)]),
+        # sweep_expired() batches that passed their expiry date since the last sweep
+        IndexModel([("expired", ASCENDING), ("expiry_date", ASCENDING)]),
+    ],
+    "sales": [
+        # sales() list (keyset on date, _id) and dashboard() recent sales
+        IndexModel([("date", DESCENDING), ("_id", DESCENDING)]),
+        # sales() filtered by payment method
+        IndexModel([("payment_method", ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)]),
+        # view_customer() sales history (keyset on date, _id)
+        IndexModel([("customer_id", ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)]),
+        # seed_invoice_counter() highest invoice number lookup
+        IndexModel([("invoice_number", ASCENDING)]),
+        # ingest_sales() replay detection; only API sales carry a key
+        IndexModel([("idempotency_key", ASCENDING)], unique=True,
+                   partialFilterExpression={"idempotency_key": {"$exists": True}}),
+    ],
+    "refunds": [
+        # refund_sale() page: earlier refunds of the sale
+        IndexModel([("sale_id", ASCENDING), ("date", ASCENDING)]),
+    ],
+    "stock_movements": [
+        # stock_at() and verify_stock(): a batch's movements after a snapshot
+        IndexModel([("medicine_id", ASCENDING), ("at", ASCENDING)]),
+    ],
+    "stock_snapshots": [
+        # stock_at() nearest earlier snapshot, snapshot_stock() latest per batch
+        IndexModel([("medicine_id", ASCENDING), ("at", DESCENDING)]),
+    ],
+    "customers": [
+        # search_customers() prefix lookups on normalized name tokens / phone suffixes
+        IndexModel([("search_keys", ASCENDING)]),
+        # customers() list sorted by name
+        IndexModel([("name", ASCENDING)]),
+    ],
+}
+
+
+def ensure_indexes(db, logger=None):
+    """Create every declared index. Safe to run repeatedly.
+
+    Each collection's indexes are created in one round trip. If that fails
+    (for example a unique index over existing duplicate data) they are
+    retried one by one so that the failure does not block the rest.
+    Returns a list of (collection, index name or error) tuples.
+    """
+    results = []
+    for coll_name, models in INDEXES.items():
+        try:
+            results += [(coll_name, name) for name in db[coll_name].create_indexes(models)]
+            continue
+        except OperationFailure:
+            pass
+        for model in models:
+            try:
+                name = db[coll_name].create_indexes([model])[0]
+                results.append((coll_name, name))
+            except OperationFailure as e:
+                if logger:
+                    logger.warning(f"Could not create index {model.document['key']} on {coll_name}: {e}")
+                results.append((coll_name, f"error: {e}"))
+    return results
+
+
+def route_queries(db):
+    """Cursors equivalent to the queries issued by each route, keyed by route."""
+    now = datetime.utcnow()
+    return {
+        "dashboard:expiring": db.medicines.find({"expiry_alert_at": {"$lte": now}}).sort("expiry_alert_at"),
+        "dashboard:low_stock": db.medicines.find({"low_stock": True}).sort("quantity"),
+        "sweep_expired": db.medicines.find({"expired": {"$ne": True}, "expiry_date": {"$lte": now}}),
+        "bootstrap_database:watch_fields": db.medicines.find({"expiry_alert_at": {"$exists": False}}),
+        "inventory": db.medicines.find({"general": False}).sort([("name", 1), ("_id", 1)]).limit(51),
+        "inventory:expiry": db.medicines.find({"general": False}).sort([("expiry_date", -1), ("_id", -1)]).limit(51),
+        "inventory:quantity": db.medicines.find({"general": False}).sort([("quantity", 1), ("_id", 1)]).limit(51),
+        "general_inventory": db.medicines.find({"general": True}).sort([("name", 1), ("_id", 1)]).limit(51),
+        "new_sale:fefo": db.medicines.find(
+            {"name": {"$in": ["Paracetamol 500"]}, "quantity": {"$gt": 0}, "expired": {"$ne": True},
+             "expiry_date": {"$gt": now}}
+        ).sort([("name", ASCENDING), ("expiry_date", ASCENDING), ("_id", ASCENDING)]),
+        "demand_report:catalog": db.medicines.find({"name": {"$in": ["Paracetamol 500"]}}),
+        "add_medicine:duplicate_batch": db.medicines.find({"batch_number": ""}).limit(1),
+        "sales": db.sales.find().sort([("date", DESCENDING), ("_id", DESCENDING)]),
+        "sales:payment_method": db.sales.find({"payment_method": "Cash"}).sort(
+            [("date", DESCENDING), ("_id", DESCENDING)]),
+        "seed_invoice_counter": db.sales.find().sort("invoice_number", DESCENDING).limit(1),
+        "search_customers": db.customers.find(customer_search_filter("ram")).sort("name", 1).limit(10),
+        "view_customer": db.sales.find({"customer_id": ObjectId()}).sort(
+            [("date", DESCENDING), ("_id", DESCENDING)]).limit(21),
+        "ingest_sales": db.sales.find({"idempotency_key": {"$in": ["a", "b"]}}),
+        "stock_at:snapshot": db.stock_snapshots.find({"medicine_id": ObjectId(), "at": {"$lte": now}}).sort(
+            "at", DESCENDING).limit(1),
+        "stock_at:movements": db.stock_movements.find({"medicine_id": ObjectId(), "at": {"$gt": now}}).sort("at"),
+        "refund_sale": db.refunds.find({"sale_id": ObjectId()}).sort("date", ASCENDING),
+    }
+
+
+def _plan_stages(plan):
+    """Yield every stage name found in an explain() plan tree."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+
+def check_query_plans(db):
+    """Explain each route query and return the routes whose winning plan is a COLLSCAN."""
+    failures = []
+    for route, cursor in route_queries(db).items():
+        winning_plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in _plan_stages(winning_plan):
+            failures.append(route)
+    return failures
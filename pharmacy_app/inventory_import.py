@@ -0,0 +1,164 @@
+import codecs
+import csv
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from medicine_form import parse_medicine
+from stock_ledger import movement, record_movements
+from watchlist import watch_fields
+
+
+# Rows validated, checked for duplicates and written per round trip
+IMPORT_CHUNK_SIZE = 500
+
+# Only written when an update_existing row creates the batch; an existing
+# batch keeps its category
+INSERT_ONLY_FIELDS = ("general",)
+
+# Column headers are matched case-insensitively with spaces as underscores,
+# using the add-medicine form field names: name, batch_number, add_by,
+# strips_count, units_per_strip, price_per_strip, price_per_unit, quantity,
+# cost_price, supplier, company, mfg_date, expiry_date.
+
+
+def _normalize_header(header):
+    return _clean(header).lower().replace(" ", "_")
+
+
+def _clean(value):
+    return "" if value is None else str(value).strip()
+
+
+def iter_csv_rows(stream):
+    """(line number, row dict keyed by normalized header) from a binary CSV stream, read lazily."""
+    reader = csv.reader(codecs.iterdecode(stream, "utf-8-sig"))
+    headers = [_normalize_header(h) for h in next(reader, [])]
+    for values in reader:
+        if any(_clean(v) for v in values):
+            yield reader.line_num, dict(zip(headers, values))
+
+
+def iter_xlsx_rows(stream):
+    """(row number, row dict keyed by normalized header) from the first sheet of an XLSX workbook."""
+    # openpyxl is only needed for spreadsheet imports
+    from openpyxl import load_workbook
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        headers = [_normalize_header(h) for h in next(rows, [])]
+        for row_number, values in enumerate(rows, start=2):
+            if any(_clean(v) for v in values):
+                yield row_number, dict(zip(headers, values))
+    finally:
+        workbook.close()
+
+
+def iter_rows(stream, filename):
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        return iter_xlsx_rows(stream)
+    return iter_csv_rows(stream)
+
+
+def _write_chunk(db, chunk, update_existing, report, now):
+    """Validate and write one chunk of (row number, row) pairs."""
+    parsed = []
+    seen = set()
+    for row_number, row in chunk:
+        try:
+            med = parse_medicine(row)
+        except (ValueError, TypeError) as e:
+            report["errors"].append({"row": row_number, "batch_number": _clean(row.get("batch_number")), "error": str(e)})
+            continue
+        if med["batch_number"] in seen:
+            report["errors"].append({"row": row_number, "batch_number": med["batch_number"],
+                                     "error": "Batch number repeated in the file."})
+            continue
+        seen.add(med["batch_number"])
+        parsed.append((row_number, med))
+    if not parsed:
+        return
+
+    if update_existing:
+        # Quantities being overwritten, for the stock ledger, and what the
+        # watch fields of an existing batch depend on beyond the row
+        previous = {
+            doc["batch_number"]: doc for doc in
+            db.medicines.find({"batch_number": {"$in": [med["batch_number"] for _, med in parsed]}},
+                              {"batch_number": 1, "quantity": 1, "general": 1,
+                               "low_stock_threshold": 1, "expiry_alert_days": 1})
+        }
+        ops = []
+        for _, med in parsed:
+            insert_only = {field: med.pop(field) for field in INSERT_ONLY_FIELDS}
+            old = previous.get(med["batch_number"])
+            med.update(watch_fields({**insert_only, **old, **med} if old else {**insert_only, **med}, now))
+            ops.append(UpdateOne({"batch_number": med["batch_number"]},
+                                 {"$set": med, "$setOnInsert": insert_only}, upsert=True))
+        result = db.medicines.bulk_write(ops, ordered=False)
+        report["inserted"] += result.upserted_count
+        report["updated"] += result.matched_count
+        movements = []
+        for index, (_, med) in enumerate(parsed):
+            if index in result.upserted_ids:
+                movements.append(movement(result.upserted_ids[index], med["quantity"], "imported", at=now))
+            elif med["batch_number"] in previous:
+                old = previous[med["batch_number"]]
+                movements.append(movement(old["_id"], med["quantity"] - (old.get("quantity") or 0), "imported", at=now))
+        record_movements(db, movements)
+        return
+
+    # One query for every batch number in the chunk
+    existing = {
+        doc["batch_number"] for doc in
+        db.medicines.find({"batch_number": {"$in": [med["batch_number"] for _, med in parsed]}}, {"batch_number": 1})
+    }
+    new_rows = []
+    for row_number, med in parsed:
+        med.update(watch_fields(med, now))
+        if med["batch_number"] in existing:
+            report["errors"].append({"row": row_number, "batch_number": med["batch_number"],
+                                     "error": "Batch number already exists!"})
+        else:
+            new_rows.append((row_number, med))
+    if not new_rows:
+        return
+    failed = {}
+    try:
+        db.medicines.insert_many([med for _, med in new_rows], ordered=False)
+        report["inserted"] += len(new_rows)
+    except BulkWriteError as e:
+        # Batches added by someone else since the duplicate check
+        failed = {err["index"]: err.get("errmsg", "") for err in e.details.get("writeErrors", [])}
+        report["inserted"] += len(new_rows) - len(failed)
+        for index, message in failed.items():
+            row_number, med = new_rows[index]
+            report["errors"].append({"row": row_number, "batch_number": med["batch_number"],
+                                     "error": "Batch number already exists!" if "E11000" in message else message})
+    record_movements(db, [
+        movement(med["_id"], med["quantity"], "imported", at=now)
+        for index, (_, med) in enumerate(new_rows) if index not in failed
+    ])
+
+
+def import_medicines(db, rows, update_existing=False, chunk_size=IMPORT_CHUNK_SIZE):
+    """Import medicine rows in chunks, holding at most one chunk in memory.
+
+    Each chunk costs one duplicate check, one unordered write and one stock
+    ledger insert. Rows whose
+    batch number already exists are reported as errors, or overwritten when
+    update_existing is set (keeping the batch's category and threshold overrides). `rows` yields (row number, row dict) pairs as
+    produced by iter_rows(). Returns {"inserted", "updated", "errors": [{row, batch_number, error}]}.
+    """
+    report = {"inserted": 0, "updated": 0, "errors": []}
+    now = datetime.utcnow()
+    chunk = []
+    for row_number, row in rows:
+        chunk.append((row_number, row))
+        if len(chunk) == chunk_size:
+            _write_chunk(db, chunk, update_existing, report, now)
+            chunk = []
+    if chunk:
+        _write_chunk(db, chunk, update_existing, report, now)
+    return report
@@ -0,0 +1,132 @@
+import base64
+
+from bson import json_util
+from pymongo import ASCENDING, DESCENDING
+
+from watchlist import LOW_STOCK_AT
+
+
+PAGE_SIZE = 50
+
+# Rows fetched per round trip when a whole listing is streamed out
+STREAM_BATCH_SIZE = 500
+
+# ?sort= value -> field. Each is indexed as (general, field, _id) so every
+# page is an index range scan whatever the sort.
+SORT_FIELDS = {"name": "name", "expiry": "expiry_date", "quantity": "quantity"}
+
+SEARCH_FIELDS = ("name", "batch_number", "supplier")
+
+# Only the columns the list templates display
+COLUMNS = {"name": 1, "batch_number": 1, "quantity": 1, "supplier": 1, "company": 1}
+MEDICINE_COLUMNS = {"price_per_strip": 1, "price_per_unit": 1}
+GENERAL_COLUMNS = {"price": 1}
+
+
+def _date_string(field):
+    """YYYY-MM-DD (UTC) of a stored date. Values that are not dates (strings
+    from old imports) come back as stored, and missing ones as null."""
+    return {"$cond": [
+        {"$eq": [{"$type": f"${field}"}, "date"]},
+        {"$dateToString": {"format": "%Y-%m-%d", "date": f"${field}"}},
+        {"$ifNull": [f"${field}", None]}
+    ]}
+
+
+_QUANTITY = {"$ifNull": ["$quantity", 0]}
+# The stored flag, or the same comparison for documents not yet backfilled
+LOW_STOCK = {"$ifNull": ["$low_stock", {"$lt": [_QUANTITY, LOW_STOCK_AT]}]}
+_UNITS_PER_STRIP = {"$cond": [{"$gt": ["$units_per_strip", 0]}, "$units_per_strip", 1]}
+
+# "<strips> strips & <loose units> units", from quantity held in units
+STOCK_DISPLAY = {"$concat": [
+    {"$toString": {"$toLong": {"$floor": {"$divide": [_QUANTITY, _UNITS_PER_STRIP]}}}},
+    " strips & ",
+    {"$toString": {"$toLong": {"$mod": [_QUANTITY, _UNITS_PER_STRIP]}}},
+    " units"
+]}
+
+
+def encode_cursor(row):
+    """Opaque ?after= token for the row a page ended on."""
+    return base64.urlsafe_b64encode(json_util.dumps([row.get("sort_value"), row["_id"]]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    sort_value, row_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return sort_value, row_id
+
+
+def _keyset(field, direction, sort_value, row_id):
+    """Rows after (sort_value, row_id) in the (field, _id) order.
+
+    Null and missing values sort before everything else, and a range
+    comparison against null matches nothing, so they get their own branches.
+    """
+    op = "$gt" if direction == ASCENDING else "$lt"
+    if sort_value is None:
+        if direction == ASCENDING:
+            return {"$or": [{field: {"$ne": None}}, {field: None, "_id": {op: row_id}}]}
+        return {field: None, "_id": {op: row_id}}
+    after = [{field: {op: sort_value}}, {field: sort_value, "_id": {op: row_id}}]
+    if direction != ASCENDING:
+        after.append({field: None})
+    return {"$or": after}
+
+
+def listing_filter(general, search=""):
+    query = {"general": general}
+    if search:
+        query["$or"] = [{field: {"$regex": search, "$options": "i"}} for field in SEARCH_FIELDS]
+    return query
+
+
+def listing_pipeline(general, search="", sort="name", direction=ASCENDING, after=None, limit=None):
+    """Aggregation producing display-ready rows, sorted on (sort field, _id).
+
+    `after` is a decoded cursor; only rows past it in the sort order are returned.
+    """
+    field = SORT_FIELDS[sort]
+    match = listing_filter(general, search)
+    if after is not None:
+        match = {"$and": [match, _keyset(field, direction, *after)]}
+
+    project = dict(COLUMNS, **(GENERAL_COLUMNS if general else MEDICINE_COLUMNS))
+    project.update({
+        "mfg_date": _date_string("mfg_date"),
+        "expiry_date": _date_string("expiry_date"),
+        "low_stock": LOW_STOCK,
+        "sort_value": {"$ifNull": [f"${field}", None]}
+    })
+    if not general:
+        project["stock_display"] = STOCK_DISPLAY
+
+    pipeline = [{"$match": match}, {"$sort": {field: direction, "_id": direction}}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$project": project})
+    return pipeline
+
+
+def load_page(db, general, search="", sort="name", direction=ASCENDING, after=None, page_size=PAGE_SIZE):
+    """One page of the listing and the cursor for the next page (None on the last)."""
+    rows = list(db.medicines.aggregate(listing_pipeline(general, search, sort, direction, after, page_size + 1)))
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1])
+    return rows, next_cursor
+
+
+def iter_listing(db, general, search="", sort="name", direction=ASCENDING):
+    """Every matching row as a lazily consumed cursor, for streamed full listings."""
+    return db.medicines.aggregate(listing_pipeline(general, search, sort, direction),
+                                  batchSize=STREAM_BATCH_SIZE)
+
+
+def parse_sort(args):
+    """(sort key, direction) from request args, falling back to name ascending."""
+    sort = args.get("sort", "name")
+    if sort not in SORT_FIELDS:
+        sort = "name"
+    return sort, DESCENDING if args.get("dir") == "desc" else ASCENDING
@@ -0,0 +1,126 @@
+from bson.objectid import ObjectId
+
+from cache import TTLCache
+from sale_snapshots import unsnapshotted_ids
+
+
+# Assembled invoices keyed by sale id. Each entry holds the sale, its line
+# items, any HTML already rendered from them (keyed by template name) and the
+# version they were built at: the sale's refund count and the customer's
+# details, re-read on every request so edits made by any process show up.
+invoice_cache = TTLCache(maxsize=500, ttl=3600)
+
+
+def _invoice_pipeline(match):
+    return [
+        {"$match": match},
+        {"$lookup": {
+            "from": "customers",
+            "localField": "customer_id",
+            "foreignField": "_id",
+            "as": "customer"
+        }}
+    ]
+
+
+def _legacy_medicines(db, sale):
+    """Medicines for lines recorded before item snapshots; empty for newer sales."""
+    medicine_ids = unsnapshotted_ids([sale])
+    if not medicine_ids:
+        return {}
+    return {med["_id"]: med for med in db.medicines.find(
+        {"_id": {"$in": list(medicine_ids)}},
+        {"name": 1, "batch_number": 1, "price_per_strip": 1, "price_per_unit": 1}
+    )}
+
+
+def _attach_customer(sale):
+    customer = sale.pop("customer")[0] if sale.get("customer") else None
+    sale["customer_name"] = customer["name"] if customer else "Walk-in Customer"
+    sale["customer_phone"] = customer.get("phone", "") if customer else ""
+    sale["customer_address"] = customer.get("address", "") if customer else ""
+    return sale
+
+
+def _invoice_version(sale):
+    return (sale.get("refund_count"), sale["customer_name"], sale["customer_phone"], sale["customer_address"])
+
+
+def _assemble_invoice(sale, medicines):
+    """Turn a sale joined by _invoice_pipeline into (sale, items).
+
+    Lines are rendered from the snapshot stored on each sale item, at the
+    prices charged. Older lines fall back to `medicines` and are left out
+    if their batch no longer exists.
+    """
+    _attach_customer(sale)
+
+    # Get medicine details with strips & units
+    items = []
+    for item in sale.get("items", []):
+        med = item if "name" in item else medicines.get(ObjectId(item["medicine_id"]))
+        if med:
+            strips = item['strips']
+            units = item['units']
+            line_total = strips * (med.get("price_per_strip") or 0) + units * (med.get("price_per_unit") or 0)
+
+            items.append({
+                "medicine_name": med["name"],
+                "batch_number": med.get("batch_number", ""),
+                "quantity": f"{strips} strips & {units} units",
+                "ps": med.get('price_per_strip') or 0,
+                "pu": med.get('price_per_unit') or 0,
+                "total": item.get("total", line_total),
+            })
+
+    return sale, items
+
+
+def build_invoice(db, sale_id):
+    """Load a sale with its customer in a single aggregation.
+
+    Returns (sale, items) or None when the sale does not exist.
+    """
+    result = list(db.sales.aggregate(_invoice_pipeline({"_id": ObjectId(sale_id)})))
+    if not result:
+        return None
+    return _assemble_invoice(result[0], _legacy_medicines(db, result[0]))
+
+
+def iter_invoices(db, match, batch_size=100):
+    """Yield (sale, items) for every sale matching `match`, oldest first, from one cursor."""
+    pipeline = _invoice_pipeline(match)
+    pipeline.insert(1, {"$sort": {"date": 1, "_id": 1}})
+    for sale in db.sales.aggregate(pipeline, batchSize=batch_size):
+        yield _assemble_invoice(sale, _legacy_medicines(db, sale))
+
+
+def get_invoice(db, sale_id):
+    """Return the cached invoice entry for a sale, building it on a miss.
+
+    The entry is a dict with "sale", "items" and "html" keys, or None when
+    the sale does not exist. A hit still costs one indexed aggregation to
+    check the refund count and customer details against the cached version.
+    """
+    sale_id = str(ObjectId(sale_id))
+    current = next(db.sales.aggregate([
+        {"$match": {"_id": ObjectId(sale_id)}},
+        {"$project": {"refund_count": 1, "customer_id": 1}},
+        {"$lookup": {"from": "customers", "localField": "customer_id", "foreignField": "_id", "as": "customer"}}
+    ]), None)
+    if current is None:
+        invoice_cache.pop(sale_id)
+        return None
+    entry = invoice_cache.get(sale_id)
+    if entry is None or entry["version"] != _invoice_version(_attach_customer(current)):
+        invoice = build_invoice(db, sale_id)
+        if invoice is None:
+            return None
+        sale, items = invoice
+        entry = {"sale": sale, "items": items, "html": {}, "version": _invoice_version(sale)}
+        invoice_cache.set(sale_id, entry)
+    return entry
+
+
+def invalidate_invoice(sale_id):
+    invoice_cache.pop(str(sale_id))
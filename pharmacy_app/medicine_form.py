@@ -0,0 +1,94 @@
+from datetime import datetime
+
+
+class InvalidMedicine(ValueError):
+    pass
+
+
+def _text(value):
+    return "" if value is None else str(value).strip()
+
+
+def _int(value):
+    # Spreadsheet cells arrive as numbers, form fields as strings
+    if isinstance(value, (int, float)):
+        return int(value)
+    return int(_text(value) or 0)
+
+
+def _float(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return float(_text(value) or 0)
+
+
+def _date(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(_text(value), '%Y-%m-%d')
+
+
+def parse_medicine(fields):
+    """Medicine document from the add-medicine form fields, or an import row using the same names.
+
+    add_by "strip": strips_count strips of units_per_strip units priced per
+    strip, with price_per_unit derived unless given. Otherwise quantity
+    units priced per unit. Quantity is always stored in units. Raises
+    InvalidMedicine for rule violations and ValueError for unparseable values.
+    """
+    if not _text(fields.get('name')) or not _text(fields.get('batch_number')):
+        raise InvalidMedicine('Name and batch number are required.')
+    add_by = _text(fields.get('add_by'))  # "strip" or "unit"
+
+    # Fields that will always exist in DB
+    units_per_strip = None
+    price_per_strip = None
+    price_per_unit = None
+    total_units = 0
+
+    if add_by == 'strip':
+        # Allow decimals like 1.5 strips; stored as whole units
+        strips_count = _float(fields.get('strips_count'))
+        units_per_strip = _int(fields.get('units_per_strip'))
+        price_per_strip = _float(fields.get('price_per_strip'))
+
+        if units_per_strip <= 0:
+            raise InvalidMedicine('Units per strip must be a positive integer.')
+
+        if strips_count < 0:
+            raise InvalidMedicine('Number of strips cannot be negative.')
+
+        # Calculate total units (allow non-integer strips like 1.5 -> multiply and round to nearest unit)
+        total_units = int(round(strips_count * units_per_strip))
+
+        # price_per_unit computed but user can override; prefer explicit per-unit if provided
+        if _text(fields.get('price_per_unit')) != '':
+            price_per_unit = _float(fields.get('price_per_unit'))
+        else:
+            # avoid division by zero (units_per_strip > 0 ensured above)
+            price_per_unit = price_per_strip / units_per_strip
+
+    else:  # add_by == 'unit' or default
+        price_per_unit = _float(fields.get('price_per_unit'))
+        total_units = _int(fields.get('quantity'))
+        if total_units < 0:
+            raise InvalidMedicine('Quantity cannot be negative.')
+        # price_per_strip remains None (unless user later sets it)
+
+    # Common numeric fields: cost_price (rate) stored per unit (user provides)
+    cost_price = _float(fields.get('cost_price'))
+
+    return {
+        "name": _text(fields.get('name')),
+        "batch_number": _text(fields.get('batch_number')),
+        "quantity": total_units,
+        "price_per_unit": round(float(price_per_unit or 0), 2),
+        "price_per_strip": round(price_per_strip, 2) if price_per_strip is not None else None,
+        "units_per_strip": units_per_strip,
+        "cost_price_per_unit": round(cost_price, 2),
+        "supplier": _text(fields.get('supplier')),
+        "company": _text(fields.get('company')),
+        "mfg_date": _date(fields.get('mfg_date')),
+        "expiry_date": _date(fields.get('expiry_date')),
+        "general": False
+    }
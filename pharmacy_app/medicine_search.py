@@ -0,0 +1,213 @@
+import bisect
+import json
+import threading
+import time
+import uuid
+from datetime import datetime
+
+
+SEARCH_FIELDS = {
+    "_id": 1,
+    "name": 1,
+    "batch_number": 1,
+    "price": 1,
+    "price_per_unit": 1,
+    "price_per_strip": 1,
+    "units_per_strip": 1,
+    "quantity": 1,
+    "expiry_date": 1,
+    "expired": 1
+}
+
+# Column order of the rows in snapshot()
+SNAPSHOT_FIELDS = ["_id", "name", "batch_number", "quantity", "units_per_strip", "price_per_strip",
+                   "price_per_unit", "price"]
+
+
+def _grams(text):
+    """Every substring of length 1 to 3 of text."""
+    return {text[i:i + n] for n in (1, 2, 3) for i in range(len(text) - n + 1)}
+
+
+def _in_date(med, now):
+    return not med.get("expired") and med.get("expiry_date") is not None and med["expiry_date"] > now
+
+
+class MedicineSearchIndex:
+    """In-memory substring index over sellable medicine batches.
+
+    Matches are found through an n-gram index over the distinct medicine
+    names, so a lookup never touches MongoDB. Stock, the expiry date and the
+    expired flag (set by the expiry sweep, see watchlist.py) are checked at
+    query time. The index is kept current by the write hooks in app.py
+    and fully rebuilt in the background every `rebuild_interval` seconds to
+    pick up writes made by other processes.
+    """
+
+    def __init__(self, rebuild_interval=300):
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.Lock()
+        self._batches = {}   # _id -> search result dict (with the expiry date and flag)
+        self._by_name = {}   # exact name -> set of _ids
+        self._grams = {}     # lowercase n-gram -> sorted list of exact names
+        self._built_at = None
+        self._rebuilding = False
+        # Bumped on every change; with the per-process epoch it names a snapshot version
+        self._epoch = uuid.uuid4().hex[:8]
+        self._version = 0
+        self._snapshot = None  # (version, etag, JSON body)
+
+    # --- maintenance -----------------------------------------------------
+
+    def _add(self, med, index_name=True):
+        med_id = med["_id"]
+        if med_id in self._batches:
+            self._remove(med_id)
+        name = med.get("name") or ""
+        result = {key: med[key] for key in SEARCH_FIELDS if key in med}
+        result["_id"] = str(med_id)
+        self._batches[med_id] = result
+        if name not in self._by_name:
+            self._by_name[name] = set()
+            if index_name:
+                for gram in _grams(name.lower()):
+                    bisect.insort(self._grams.setdefault(gram, []), name)
+        self._by_name[name].add(med_id)
+
+    def _remove(self, med_id):
+        result = self._batches.pop(med_id, None)
+        if result is not None:
+            # Names left without batches stay in the n-gram index until the next rebuild
+            self._by_name.get(result.get("name") or "", set()).discard(med_id)
+
+    def rebuild(self, db):
+        try:
+            cursor = db.medicines.find(
+                {"quantity": {"$gt": 0}, "expired": {"$ne": True}, "expiry_date": {"$gt": datetime.utcnow()}},
+                SEARCH_FIELDS
+            ).batch_size(5000)
+            fresh = MedicineSearchIndex()
+            for med in cursor:
+                fresh._add(med, index_name=False)
+            # Names in sorted order keep every n-gram list sorted without insort
+            for name in sorted(fresh._by_name):
+                for gram in _grams(name.lower()):
+                    fresh._grams.setdefault(gram, []).append(name)
+            with self._lock:
+                self._batches = fresh._batches
+                self._by_name = fresh._by_name
+                self._grams = fresh._grams
+                self._built_at = time.monotonic()
+                self._version += 1
+        finally:
+            self._rebuilding = False
+
+    def _ensure_fresh(self, db):
+        if self._built_at is None:
+            self.rebuild(db)
+        elif not self._rebuilding and time.monotonic() - self._built_at > self.rebuild_interval:
+            self._rebuilding = True
+            threading.Thread(target=self.rebuild, args=(db,), daemon=True).start()
+
+    def upsert(self, med):
+        """Add or replace a batch from a full medicine document."""
+        with self._lock:
+            self._add(med)
+            self._version += 1
+
+    def remove(self, med_id):
+        with self._lock:
+            self._remove(med_id)
+            self._version += 1
+
+    def refresh(self, db, med_ids):
+        """Reload the given batches from the database in one query."""
+        med_ids = list(med_ids)
+        docs = list(db.medicines.find({"_id": {"$in": med_ids}}, SEARCH_FIELDS))
+        with self._lock:
+            for med_id in med_ids:
+                self._remove(med_id)
+            for med in docs:
+                self._add(med)
+            self._version += 1
+
+    def adjust_stock(self, db, units_by_medicine):
+        """Apply stock deltas ({_id: units}) already written to the database.
+
+        Batches the index does not hold (rebuilds skip sold-out ones) are
+        loaded from the database when a delta puts stock back.
+        """
+        missing = []
+        with self._lock:
+            for med_id, delta in units_by_medicine.items():
+                result = self._batches.get(med_id)
+                if result is not None:
+                    result["quantity"] = (result.get("quantity") or 0) + delta
+                elif delta > 0:
+                    missing.append(med_id)
+            self._version += 1
+        if missing:
+            self.refresh(db, missing)
+
+    # --- lookup ----------------------------------------------------------
+
+    def _sellable(self, name, now):
+        """Sellable batches of a name, earliest expiry first: the order new_sale() allocates in."""
+        batches = [
+            self._batches[med_id] for med_id in self._by_name.get(name, ())
+            if (self._batches[med_id].get("quantity") or 0) > 0 and _in_date(self._batches[med_id], now)
+        ]
+        batches.sort(key=lambda m: (m.get("expiry_date"), m["_id"]))
+        return batches
+
+    def search(self, db, query, limit=10):
+        """Sellable batches whose name contains query, ordered by name then expiry.
+
+        Each result also carries name_quantity and name_batches, the stock
+        and batch count over every sellable batch of its name.
+        """
+        self._ensure_fresh(db)
+        needle = query.lower()
+        now = datetime.utcnow()
+        results = []
+        with self._lock:
+            # n-gram lists are kept sorted, so the walk stops at the limit-th hit
+            if len(needle) <= 3:
+                names = self._grams.get(needle, ())
+            else:
+                candidates = min(
+                    (self._grams.get(needle[i:i + 3], ()) for i in range(len(needle) - 2)),
+                    key=len
+                )
+                names = (name for name in candidates if needle in name.lower())
+
+            for name in names:
+                batches = self._sellable(name, now)
+                name_quantity = sum(med["quantity"] for med in batches)
+                for med in batches:
+                    result = dict(med, name_quantity=name_quantity, name_batches=len(batches))
+                    result.pop("expired", None)
+                    result.pop("expiry_date", None)
+                    results.append(result)
+                    if len(results) == limit:
+                        return results
+        return results
+
+    def snapshot(self, db):
+        """(etag, JSON body) of every sellable batch, for clients to search offline.
+
+        The body is {"fields": [...], "rows": [[...], ...]} ordered by name then
+        expiry, serialized once per index version.
+        """
+        self._ensure_fresh(db)
+        now = datetime.utcnow()
+        with self._lock:
+            if self._snapshot is None or self._snapshot[0] != self._version:
+                rows = [
+                    [med.get(field) for field in SNAPSHOT_FIELDS]
+                    for name in sorted(self._by_name)
+                    for med in self._sellable(name, now)
+                ]
+                body = json.dumps({"fields": SNAPSHOT_FIELDS, "rows": rows}, separators=(",", ":"))
+                self._snapshot = (self._version, f"{self._epoch}-{self._version}", body)
+            return self._snapshot[1], self._snapshot[2]
@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import deque
+
+from flask import g, has_request_context, request
+from pymongo import monitoring
+
+
+SLOW_COMMAND_MS = 100
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+DOCUMENT_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with a single `route` label."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}   # route -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, route, value):
+        with self._lock:
+            series = self._series.setdefault(route, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for route, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{route="{route}",le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{route="{route}",le="+Inf"}} {series[-1]}')
+                lines.append(f'{self.name}_sum{{route="{route}"}} {series[-2]}')
+                lines.append(f'{self.name}_count{{route="{route}"}} {series[-1]}')
+        return lines
+
+
+request_duration = Histogram("pharmacy_request_duration_seconds", "Time spent handling the request.", REQUEST_BUCKETS)
+db_time = Histogram("pharmacy_db_time_seconds", "Time spent in MongoDB commands per request.", REQUEST_BUCKETS)
+db_commands = Histogram("pharmacy_db_commands", "MongoDB round trips per request.", COUNT_BUCKETS)
+db_documents = Histogram("pharmacy_db_documents_returned", "Documents returned by MongoDB per request.", DOCUMENT_BUCKETS)
+
+# Most recent slow commands with the shape of their filters, newest last
+slow_commands = deque(maxlen=100)
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.commands = 0
+        self.db_seconds = 0.0
+        self.documents = 0
+
+
+def query_shape(value):
+    """A filter or pipeline with its values replaced by "?", keeping operators,
+    field names and $field references, so slow queries can be shown without
+    exposing customer data."""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = [query_shape(item) for item in value[:3]]
+        return shapes + ["..."] if len(value) > 3 else shapes
+    if isinstance(value, str) and value.startswith("$"):
+        return value
+    return "?"
+
+
+def _documents_in(reply):
+    cursor = reply.get("cursor") if isinstance(reply, dict) else None
+    if cursor:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    return 0
+
+
+class QueryTracer(monitoring.CommandListener):
+    """Attributes every MongoDB command to the Flask request that issued it.
+
+    Listener callbacks run on the thread that issued the command, so the
+    request context (and its RequestStats on `g`) is available.
+    """
+
+    def __init__(self, logger=None, slow_ms=SLOW_COMMAND_MS):
+        self.logger = logger
+        self.slow_ms = slow_ms
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if not has_request_context() or "db_stats" not in g:
+            return
+        command = event.command
+        query_filter = command.get("filter", command.get("q", command.get("pipeline")))
+        with self._lock:
+            self._pending[event.request_id] = (g.db_stats, request.endpoint, event.command_name,
+                                               event.database_name, command.get(event.command_name), query_filter)
+
+    def _finish(self, event, reply):
+        with self._lock:
+            pending = self._pending.pop(event.request_id, None)
+        if pending is None:
+            return
+        stats, endpoint, command_name, database, collection, query_filter = pending
+        seconds = event.duration_micros / 1e6
+        stats.commands += 1
+        stats.db_seconds += seconds
+        stats.documents += _documents_in(reply)
+        if seconds * 1000 >= self.slow_ms:
+            entry = {
+                "route": endpoint,
+                "command": command_name,
+                "collection": f"{database}.{collection}",
+                "filter": repr(query_shape(query_filter)),
+                "ms": round(seconds * 1000, 1),
+                "at": time.strftime('%Y-%m-%d %H:%M:%S')
+            }
+            slow_commands.append(entry)
+            if self.logger:
+                self.logger.warning(f"Slow MongoDB command: {entry}")
+
+    def succeeded(self, event):
+        self._finish(event, event.reply)
+
+    def failed(self, event):
+        self._finish(event, None)
+
+
+def begin_request():
+    g.db_stats = RequestStats()
+
+
+def _observe(route, stats):
+    if route != "metrics":
+        request_duration.observe(route, time.perf_counter() - stats.started)
+        db_time.observe(route, stats.db_seconds)
+        db_commands.observe(route, stats.commands)
+        db_documents.observe(route, stats.documents)
+
+
+def end_request(response, add_header=False):
+    """Record the request in the histograms and optionally expose its round trips.
+
+    A streamed body issues its queries after this runs, so streamed
+    responses (generated under stream_with_context) are recorded when they
+    close instead; the header then only counts the round trips made before
+    streaming started.
+    """
+    stats = g.get("db_stats")
+    if stats is None:
+        return response
+    route = request.endpoint or "unmatched"
+    if add_header:
+        response.headers["X-DB-Round-Trips"] = str(stats.commands)
+        response.headers["X-DB-Time-ms"] = f"{stats.db_seconds * 1000:.1f}"
+    if response.is_streamed:
+        response.call_on_close(lambda: _observe(route, stats))
+    else:
+        g.pop("db_stats")
+        _observe(route, stats)
+    return response
+
+
+def render_metrics():
+    lines = []
+    for histogram in (request_duration, db_time, db_commands, db_documents):
+        lines += histogram.render()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,227 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import zipfile
+from collections import deque
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
+
+import pytz
+
+from cache import BytesLRUCache
+from invoices import iter_invoices
+
+
+FONT_PATH = os.path.join(os.path.dirname(__file__), "DejaVuSans.ttf")
+_font_registered = False
+
+STORE_NAME = "Sanskar Medical"
+STORE_ADDRESS = [
+    "Shop No.35, Pratibha Sa, Ghadge Nagar, Nashik Road, Nashik",
+    "Phone: 94229 90414 / 80070 74991",
+    "DL.NO: 20-433500 / 21-433501",
+]
+
+# Generated PDFs keyed by (sale id, content hash), bounded by total size
+pdf_cache = BytesLRUCache(max_bytes=int(os.environ.get("PDF_CACHE_BYTES", 32 * 1024 * 1024)))
+
+# Sales rendered ahead of the ZIP being streamed out
+PDF_EXPORT_WINDOW = 16
+
+_pool = None
+
+
+def _register_font():
+    """Parse and register DejaVuSans on first use rather than at import."""
+    global _font_registered
+    if not _font_registered:
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        pdfmetrics.registerFont(TTFont('DejaVuSans', FONT_PATH))
+        _font_registered = True
+
+
+def _local_date(date, tz):
+    """Calendar day of a stored UTC datetime in the store's timezone."""
+    if date.tzinfo is None:
+        date = pytz.utc.localize(date)
+    return date.astimezone(tz).strftime('%Y-%m-%d')
+
+
+def render_invoice_pdf(sale, items, tz):
+    """Render one invoice as PDF bytes. Runs in the web process or a pool worker."""
+    # ReportLab is imported here so that only requests producing a PDF pay for it
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    from reportlab.lib.units import inch
+    _register_font()
+
+    styles = getSampleStyleSheet()
+    normal = ParagraphStyle('Invoice', parent=styles['Normal'], fontName='DejaVuSans', fontSize=9, leading=12)
+    title = ParagraphStyle('Store', parent=normal, fontSize=20, leading=24, alignment=1)
+    centered = ParagraphStyle('Centered', parent=normal, alignment=1)
+
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, leftMargin=0.6 * inch, rightMargin=0.6 * inch,
+                            topMargin=0.6 * inch, bottomMargin=0.6 * inch,
+                            title=f"Invoice {sale.get('invoice_number', '')}")
+
+    story = [Paragraph(STORE_NAME, title), Spacer(1, 4)]
+    story += [Paragraph(line, centered) for line in STORE_ADDRESS]
+    story.append(Spacer(1, 14))
+
+    date = sale.get("date")
+    customer_lines = [f"<b>To:</b> {escape(sale.get('customer_name', 'Walk-in Customer'))}"]
+    if sale.get("customer_address"):
+        customer_lines.append(escape(sale["customer_address"]).replace("\n", "<br/>"))
+    if sale.get("customer_phone"):
+        customer_lines.append(f"Phone: {escape(sale['customer_phone'])}")
+    details_lines = [
+        f"<b>Invoice ID:</b> {sale.get('invoice_number', '')}",
+        f"<b>Date:</b> {_local_date(date, tz) if date else 'N/A'}",
+        f"<b>Payment Method:</b> {escape(sale.get('payment_method') or 'N/A')}",
+    ]
+    header = Table([[Paragraph("<br/>".join(customer_lines), normal),
+                     Paragraph("<br/>".join(details_lines), normal)]],
+                   colWidths=[doc.width * 0.55, doc.width * 0.45])
+    header.setStyle(TableStyle([('VALIGN', (0, 0), (-1, -1), 'TOP')]))
+    story += [header, Spacer(1, 14)]
+
+    rows = [["#", "Medicine", "Batch Number", "Quantity", "Price (₹)", "Total (₹)"]]
+    for i, item in enumerate(items, 1):
+        rows.append([
+            str(i),
+            Paragraph(escape(item["medicine_name"]), normal),
+            item.get("batch_number") or "-",
+            item["quantity"],
+            f"{item['ps'] or 0:.2f}/ps | {item['pu'] or 0:.2f}/pu",
+            f"{item['total']:.2f}",
+        ])
+    total_amount = sale.get("total_amount", 0) or 0
+    discount = sale.get("discount", 0) or 0
+    rows += [
+        ["", "", "", "", "Subtotal:", f"₹{total_amount + discount:.2f}"],
+        ["", "", "", "", "Discount:", f"₹{discount:.2f}"],
+        ["", "", "", "", "Total Amount:", f"₹{total_amount:.2f}"],
+    ]
+    table = Table(rows, colWidths=[0.35 * inch, None, 1.1 * inch, 1.4 * inch, 1.4 * inch, 0.9 * inch], repeatRows=1)
+    table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), 'DejaVuSans'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f1f3f5')),
+        ('LINEBELOW', (0, 0), (-1, 0), 0.75, colors.grey),
+        ('LINEBELOW', (0, 1), (-1, -4), 0.25, colors.lightgrey),
+        ('ALIGN', (4, 1), (-1, -1), 'RIGHT'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('LINEABOVE', (4, -1), (-1, -1), 0.75, colors.grey),
+    ]))
+    story += [table, Spacer(1, 20), Paragraph("Thank you for your business!", centered)]
+
+    doc.build(story)
+    return buffer.getvalue()
+
+
+def _content_hash(sale, items):
+    content = (
+        sale.get("invoice_number"), sale.get("date"), sale.get("payment_method"),
+        sale.get("total_amount"), sale.get("discount"), sale.get("customer_name"),
+        sale.get("customer_phone"), sale.get("customer_address"), items
+    )
+    return hashlib.sha1(repr(content).encode()).hexdigest()
+
+
+def get_invoice_pdf(sale, items, tz):
+    """PDF bytes for an assembled invoice, served from pdf_cache when the content is unchanged."""
+    key = (str(sale["_id"]), _content_hash(sale, items))
+    pdf = pdf_cache.get(key)
+    if pdf is None:
+        pdf = render_invoice_pdf(sale, items, tz)
+        pdf_cache.set(key, pdf)
+    return pdf
+
+
+def invalidate_invoice_pdf(sale_id):
+    sale_id = str(sale_id)
+    pdf_cache.pop_matching(lambda key: key[0] == sale_id)
+
+
+def _get_pool():
+    """Process pool for bulk rendering, or None where processes are unavailable (e.g. serverless)."""
+    global _pool
+    if _pool is None:
+        try:
+            workers = int(os.environ.get("PDF_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        except (OSError, NotImplementedError):
+            _pool = False
+    return _pool or None
+
+
+class _ZipStream(io.RawIOBase):
+    """Unseekable sink for zipfile; written bytes are drained after each entry."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _render_pdfs(invoices, tz):
+    """Yield (sale, pdf bytes) in order, rendering a bounded window ahead in the pool."""
+    pool = _get_pool()
+    if pool is None:
+        for sale, items in invoices:
+            yield sale, get_invoice_pdf(sale, items, tz)
+        return
+
+    pending = deque()
+    for sale, items in invoices:
+        key = (str(sale["_id"]), _content_hash(sale, items))
+        pdf_or_future = pdf_cache.get(key)
+        if pdf_or_future is None:
+            try:
+                pdf_or_future = pool.submit(render_invoice_pdf, sale, items, tz)
+            except (OSError, RuntimeError):
+                # Worker processes could not be started; render here instead
+                pdf_or_future = render_invoice_pdf(sale, items, tz)
+        pending.append((sale, key, pdf_or_future))
+        if len(pending) >= PDF_EXPORT_WINDOW:
+            yield _collect(*pending.popleft())
+    while pending:
+        yield _collect(*pending.popleft())
+
+
+def _collect(sale, key, pdf_or_future):
+    if isinstance(pdf_or_future, bytes):
+        return sale, pdf_or_future
+    pdf = pdf_or_future.result()
+    pdf_cache.set(key, pdf)
+    return sale, pdf
+
+
+def stream_invoice_zip(db, match, tz):
+    """Generate a ZIP archive of the invoices for every sale matching `match`, chunk by chunk.
+
+    Dates in the PDFs and file names are local to tz, like the range filter.
+    """
+    sink = _ZipStream()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        for sale, pdf in _render_pdfs(iter_invoices(db, match), tz):
+            sale_date = _local_date(sale["date"], tz) if sale.get("date") else "undated"
+            archive.writestr(f"invoice-{sale.get('invoice_number', sale['_id'])}-{sale_date}.pdf", pdf)
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,171 @@
+from bson.objectid import ObjectId
+from customer_stats import apply_customer_stats
+from rollups import ROLLUP_COLLECTION, apply_rollup, rollup_update
+from sale_ingest import VOIDED_SALES_COLLECTION
+from stock import run_transaction, restore_stock
+from stock_ledger import record_movements, stock_movements
+from watchlist import refresh_stock_flags
+
+
+# Partial refunds are recorded on the sale itself so every aggregate can be
+# derived from it:
+#   sale.refunded_amount, sale.refund_count
+#   item.refunded_units, item.refunded_total, item.refunded_cost
+# plus one document per refund in the refunds collection:
+#   {sale_id, invoice_number, customer_id, date, amount, cost,
+#    lines: [{line, medicine_id, name, batch_number, units, amount, cost}]}
+# refund_count guards against two reversals of the same sale racing.
+
+
+class InvalidRefund(ValueError):
+    pass
+
+
+class ReversalConflict(Exception):
+    pass
+
+
+def line_units(item):
+    """Units sold on a line; lines from before total_units was stored are derived from the strip size."""
+    if "total_units" in item:
+        return item["total_units"]
+    return item.get("strips", 0) * (item.get("units_per_strip") or 1) + item.get("units", 0)
+
+
+def refundable_units(item):
+    return line_units(item) - item.get("refunded_units", 0)
+
+
+def remaining_stock(sale):
+    """{medicine _id: units} still out on a sale, i.e. what voiding it puts back."""
+    units_by_medicine = {}
+    for item in sale.get("items", []):
+        med_id = ObjectId(item["medicine_id"])
+        units_by_medicine[med_id] = units_by_medicine.get(med_id, 0) + refundable_units(item)
+    return {med_id: units for med_id, units in units_by_medicine.items() if units > 0}
+
+
+def void_sale(db, client, sale, tz):
+    """Delete a sale and put its unrefunded stock back, in one transaction.
+
+    The deletion, the stock restore and its ledger movements, the rollup,
+    the customer's stats and the low-stock flags commit together in a constant number of round trips
+    however many lines the sale has. A sale uploaded by a till leaves its
+    idempotency key behind so a replayed upload does not recreate it.
+    Returns {medicine _id: units restored}.
+    """
+    restored = remaining_stock(sale)
+
+    def reverse(session):
+        result = db.sales.delete_one({"_id": sale["_id"], "refund_count": sale.get("refund_count")}, session=session)
+        if result.deleted_count != 1:
+            raise ReversalConflict("The sale was changed or deleted meanwhile. Reload it and try again.")
+        restore_stock(db, restored, session=session)
+        record_movements(db, stock_movements(restored, 1, "voided", sale["_id"]), session=session)
+        apply_rollup(db, sale, tz, sign=-1, session=session)
+        apply_customer_stats(db, sale, sign=-1, session=session)
+        refresh_stock_flags(db, restored, session=session)
+        if sale.get("idempotency_key"):
+            db[VOIDED_SALES_COLLECTION].update_one(
+                {"_id": sale["idempotency_key"]},
+                {"$set": {"sale_id": sale["_id"], "invoice_number": sale.get("invoice_number")}},
+                upsert=True, session=session)
+
+    run_transaction(client, reverse)
+    return restored
+
+
+def plan_refund(sale, units_by_line, now):
+    """Refund document and sale $inc for refunding {line index: units}.
+
+    Amounts are the line's share of what was charged, with the sale's
+    discount spread over its lines. Raises InvalidRefund.
+    """
+    items = sale.get("items", [])
+    subtotal = sum(float(item.get("total", 0) or 0) for item in items)
+    # Fraction of list price actually charged after the discount
+    charged = float(sale.get("total_amount", 0) or 0) / subtotal if subtotal else 0
+
+    lines = []
+    inc = {}
+    for line, units in sorted(units_by_line.items()):
+        if units == 0:
+            continue
+        if line < 0 or line >= len(items):
+            raise InvalidRefund("Unknown line on this sale.")
+        item = items[line]
+        if units < 0 or units > refundable_units(item):
+            raise InvalidRefund(f"Only {refundable_units(item)} units of {item.get('name', 'this line')} can be refunded.")
+        share = units / line_units(item)
+        line_total = float(item.get("total", 0) or 0) * share
+        cost = float(item.get("cost", 0) or 0) * share
+        lines.append({
+            "line": line,
+            "medicine_id": ObjectId(item["medicine_id"]),
+            "name": item.get("name"),
+            "batch_number": item.get("batch_number"),
+            "units": units,
+            "amount": round(line_total * charged, 2),
+            "cost": cost
+        })
+        inc[f"items.{line}.refunded_units"] = units
+        inc[f"items.{line}.refunded_total"] = line_total
+        inc[f"items.{line}.refunded_cost"] = cost
+    if not lines:
+        raise InvalidRefund("Choose at least one unit to refund.")
+
+    amount = round(sum(line["amount"] for line in lines), 2)
+    inc.update({"refunded_amount": amount, "refund_count": 1})
+    refund = {
+        "sale_id": sale["_id"],
+        "invoice_number": sale.get("invoice_number"),
+        "customer_id": sale.get("customer_id"),
+        "date": now,
+        "amount": amount,
+        "cost": sum(line["cost"] for line in lines),
+        "lines": lines
+    }
+    return refund, inc
+
+
+def _apply_inc(sale, inc):
+    """Copy of the sale with a plan_refund() $inc applied, for re-deriving aggregates."""
+    after = dict(sale, items=[dict(item) for item in sale.get("items", [])])
+    for path, value in inc.items():
+        parts = path.split(".")
+        target = after["items"][int(parts[1])] if parts[0] == "items" else after
+        target[parts[-1]] = target.get(parts[-1], 0) + value
+    return after
+
+
+def refund_sale(db, client, sale, units_by_line, tz, now):
+    """Refund part of a sale and put the units back in stock, in one transaction.
+
+    Records the refund, marks the lines, restores stock and moves the
+    rollup and the customer's spend by the refunded amount. Returns
+    (refund document, {medicine _id: units restored}).
+    """
+    refund, inc = plan_refund(sale, units_by_line, now)
+    restored = {}
+    for line in refund["lines"]:
+        restored[line["medicine_id"]] = restored.get(line["medicine_id"], 0) + line["units"]
+    after = _apply_inc(sale, inc)
+
+    def record_refund(session):
+        result = db.sales.update_one({"_id": sale["_id"], "refund_count": sale.get("refund_count")},
+                                     {"$inc": inc}, session=session)
+        if result.matched_count != 1:
+            raise ReversalConflict("The sale was changed or deleted meanwhile. Reload it and try again.")
+        db.refunds.insert_one(refund, session=session)
+        restore_stock(db, restored, session=session)
+        record_movements(db, stock_movements(restored, 1, "refunded", refund["_id"]), session=session)
+        # Swap the sale's old net contribution for the new one; the day's count is unchanged
+        db[ROLLUP_COLLECTION].bulk_write([rollup_update(sale, tz, sign=-1), rollup_update(after, tz)],
+                                         session=session)
+        if sale.get("customer_id"):
+            db.customers.update_one({"_id": sale["customer_id"]}, {"$inc": {"stats.spend": -refund["amount"]}},
+                                    session=session)
+        refresh_stock_flags(db, restored, session=session)
+
+    run_transaction(client, record_refund)
+    return refund, restored
@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta
+
+import pytz
+from pymongo import UpdateOne, ASCENDING
+
+
+# One document per local calendar day, _id "YYYY-MM-DD":
+#   {month, total, count, cost, profit,
+#    medicines: {"<medicine_id>": {name, units, revenue}}}
+# Sales count net of any partial refunds recorded on them (see refunds.py).
+ROLLUP_COLLECTION = "sales_daily_rollup"
+
+
+def local_day(dt, tz):
+    """Local calendar date (YYYY-MM-DD) of a naive UTC datetime."""
+    if not isinstance(dt, datetime):
+        dt = datetime.utcfromtimestamp(dt / 1000)  # legacy epoch-millisecond dates
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    return dt.astimezone(tz).strftime('%Y-%m-%d')
+
+
+def rollup_update(sale, tz, names=None, sign=1):
+    """UpdateOne that adds (sign=1) or removes (sign=-1) a sale from its day's rollup.
+
+    Sale items are expected to carry the line "total" and "cost" recorded at
+    checkout. The report shows each line's snapshot name, or names[medicine_id]
+    for lines recorded before snapshots.
+    """
+    day = local_day(sale["date"], tz)
+    total_amount = float(sale.get("total_amount", 0) or 0) - float(sale.get("refunded_amount", 0) or 0)
+    cost = 0.0
+    inc = {}
+    set_fields = {"month": day[:7]}
+    for item in sale.get("items", []):
+        item_cost = float(item.get("cost", 0) or 0) - float(item.get("refunded_cost", 0) or 0)
+        cost += item_cost
+        key = f"medicines.{item['medicine_id']}"
+        units = item.get("total_units", 0) - item.get("refunded_units", 0)
+        revenue = float(item.get("total", item.get("price", 0)) or 0) - float(item.get("refunded_total", 0) or 0)
+        inc[f"{key}.units"] = inc.get(f"{key}.units", 0) + sign * units
+        inc[f"{key}.revenue"] = inc.get(f"{key}.revenue", 0) + sign * revenue
+        name = item.get("name") or (names or {}).get(item["medicine_id"])
+        if name:
+            set_fields[f"{key}.name"] = name
+    inc.update({
+        "total": sign * total_amount,
+        "count": sign,
+        "cost": sign * cost,
+        "profit": sign * (total_amount - cost)
+    })
+    return UpdateOne({"_id": day}, {"$inc": inc, "$set": set_fields}, upsert=True)
+
+
+def apply_rollup(db, sale, tz, names=None, sign=1, session=None):
+    db[ROLLUP_COLLECTION].bulk_write([rollup_update(sale, tz, names, sign)], session=session)
+
+
+def rebuild_rollups(db, tz, batch_size=1000):
+    """Recompute every rollup from the raw sales, reading them in date order in batches.
+
+    Costs missing from older sales are derived from the current medicine
+    documents; lines without a stored total fall back to their price. Sales recorded while this runs may be
+    counted twice or not at all, so run it while the tills are idle.
+    Returns the number of sales processed.
+    """
+    db[ROLLUP_COLLECTION].delete_many({})
+    processed = 0
+    batch = []
+    cursor = db.sales.find({}, {"date": 1, "total_amount": 1, "refunded_amount": 1, "items": 1}).sort("date", ASCENDING).batch_size(batch_size)
+    for sale in cursor:
+        batch.append(sale)
+        if len(batch) == batch_size:
+            processed += _rollup_batch(db, batch, tz)
+            batch = []
+    if batch:
+        processed += _rollup_batch(db, batch, tz)
+    return processed
+
+
+def _rollup_batch(db, sales, tz):
+    # Only lines from before item snapshots or costs need the medicine documents
+    medicine_ids = {
+        item["medicine_id"] for sale in sales for item in sale.get("items", [])
+        if "name" not in item or "cost" not in item
+    }
+    meds = {
+        med["_id"]: med for med in db.medicines.find(
+            {"_id": {"$in": list(medicine_ids)}},
+            {"name": 1, "cost_price_per_unit": 1}
+        )
+    }
+    names = {med_id: med.get("name", "") for med_id, med in meds.items()}
+    ops = []
+    for sale in sales:
+        for item in sale.get("items", []):
+            med = meds.get(item["medicine_id"], {})
+            if "cost" not in item:
+                item["cost"] = item.get("total_units", 0) * (med.get("cost_price_per_unit") or 0)
+        ops.append(rollup_update(sale, tz, names))
+    db[ROLLUP_COLLECTION].bulk_write(ops, ordered=False)
+    return len(sales)
+
+
+def load_report(db, tz, days=7, months=12, top=10):
+    """Daily totals for the last `days` days, monthly totals derived from the
+    daily rollups for the last `months` months and the top medicines over the
+    daily window. Reads at most one rollup document per day shown."""
+    today = datetime.now(tz).date()
+    first_day = (today - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    month_start = today.replace(day=1)
+    for _ in range(months - 1):
+        month_start = (month_start - timedelta(days=1)).replace(day=1)
+
+    daily = list(db[ROLLUP_COLLECTION].find({"_id": {"$gte": first_day}}).sort("_id", -1))
+    daily_sales = [{"day": d["_id"], "total": d.get("total", 0)} for d in daily]
+    profit_data = [{"day": d["_id"], "profit": d.get("profit", 0)} for d in daily]
+
+    monthly_sales = [
+        {"month": m["_id"], "total": m["total"]}
+        for m in db[ROLLUP_COLLECTION].aggregate([
+            {"$match": {"_id": {"$gte": month_start.strftime('%Y-%m-%d')}}},
+            {"$group": {"_id": "$month", "total": {"$sum": "$total"}}},
+            {"$sort": {"_id": -1}}
+        ])
+    ]
+
+    medicines = {}
+    for d in daily:
+        for med_id, stats in d.get("medicines", {}).items():
+            med = medicines.setdefault(med_id, {"name": "", "total_quantity": 0, "total_sales": 0})
+            med["name"] = stats.get("name") or med["name"]
+            med["total_quantity"] += stats.get("units", 0)
+            med["total_sales"] += stats.get("revenue", 0)
+    top_medicines = sorted(
+        (m for m in medicines.values() if m["total_quantity"] > 0),
+        key=lambda m: m["total_sales"], reverse=True
+    )[:top]
+
+    return {
+        "daily_sales": daily_sales,
+        "monthly_sales": monthly_sales,
+        "top_medicines": top_medicines,
+        "profit_data": profit_data
+    }
@@ -0,0 +1,238 @@
+from datetime import datetime
+
+import pytz
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from customer_stats import customer_stats_update
+from rollups import ROLLUP_COLLECTION, rollup_update
+from sale_snapshots import item_snapshot
+from stock import deduct_stock, restore_stock, run_transaction
+from stock_ledger import record_movements, stock_movements
+from watchlist import refresh_stock_flags
+
+
+# Sales accepted per request
+MAX_INGEST_BATCH = 500
+
+# Keys of ingested sales that were later voided, {_id: idempotency_key,
+# sale_id, invoice_number}, so a replayed upload does not recreate them
+VOIDED_SALES_COLLECTION = "voided_sales"
+
+INGEST_FIELDS = {
+    "name": 1,
+    "batch_number": 1,
+    "quantity": 1,
+    "units_per_strip": 1,
+    "price_per_strip": 1,
+    "price_per_unit": 1,
+    "cost_price_per_unit": 1,
+    "expiry_date": 1
+}
+
+# Request body:
+#   {"sales": [{"idempotency_key": "<unique per sale, chosen by the till>",
+#               "customer_id": "<optional>", "payment_method": "Cash",
+#               "discount": 0, "date": "<optional ISO 8601, when it was rung up>",
+#               "items": [{"medicine_id": "...", "strips": 1, "units": 0}, ...]}]}
+# Each sale gets a result {idempotency_key, status, sale_id, invoice_number, error}
+# with status "created", "duplicate" (already recorded, possibly since
+# voided; replays are no-ops) or "rejected".
+
+
+class InvalidBatch(ValueError):
+    pass
+
+
+class BatchConflict(Exception):
+    pass
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    date = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if date.tzinfo is not None:
+        date = date.astimezone(pytz.utc).replace(tzinfo=None)
+    return date
+
+
+def _parse_sale(raw):
+    """Normalized sale fields from one request entry. Raises ValueError, TypeError or InvalidId."""
+    lines = raw.get("items") or []
+    if not isinstance(lines, list) or not all(isinstance(line, dict) for line in lines):
+        raise ValueError("items must be a list of objects.")
+    items = []
+    for line in lines:
+        strips = int(line.get("strips") or 0)
+        units = int(line.get("units") or 0)
+        if strips < 0 or units < 0:
+            raise ValueError("Quantities cannot be negative.")
+        if strips or units:
+            items.append((ObjectId(line["medicine_id"]), strips, units))
+    if not items:
+        raise ValueError("A sale needs at least one item.")
+    customer_id = raw.get("customer_id")
+    return {
+        "customer_id": ObjectId(customer_id) if customer_id else None,
+        "payment_method": raw.get("payment_method"),
+        "discount": float(raw.get("discount") or 0),
+        "date": _parse_date(raw.get("date")),
+        "items": items
+    }
+
+
+def _line_item(med, strips, units):
+    units_per_strip = med.get("units_per_strip") or 1
+    total_units = strips * units_per_strip + units
+    line_total = strips * (med.get("price_per_strip") or 0) + units * (med.get("price_per_unit") or 0)
+    return {
+        "medicine_id": med["_id"],
+        **item_snapshot(med),
+        "strips": strips,
+        "units": units,
+        "total_units": total_units,
+        "price": line_total,
+        "total": line_total,
+        "cost": total_units * (med.get("cost_price_per_unit") or 0)
+    }
+
+
+def ingest_sales(db, client, invoice_numbers, entries, tz, now):
+    """Record a batch of sales from a till, skipping any already recorded.
+
+    Round trips are constant in the batch size. There is one query for
+    replayed keys and one for every referenced medicine. Stock decrements
+    are summed per medicine, and invoice numbers come from one counter
+    update. The sales, stock, ledger movements, rollups, customer stats and
+    low-stock flags are written in one transaction.
+
+    Sales that fail validation or would oversell a batch are rejected on
+    their own while the rest go through. Returns (results,
+    {medicine _id: units sold}). Raises InsufficientStock if stock changed
+    underneath the batch and BatchConflict if another upload of the same
+    keys got in first. Nothing is left written in either case (without a
+    transaction the stock decrement and any sales inserted are undone), so
+    the till can retry.
+    """
+    if not isinstance(entries, list):
+        raise InvalidBatch('Expected {"sales": [...]}.')
+    if len(entries) > MAX_INGEST_BATCH:
+        raise InvalidBatch(f"At most {MAX_INGEST_BATCH} sales per batch.")
+
+    results = []
+    parsed = []  # (result, sale fields)
+    seen = set()
+    for raw in entries:
+        key = raw.get("idempotency_key") if isinstance(raw, dict) else None
+        result = {"idempotency_key": key, "status": "rejected"}
+        results.append(result)
+        if not key or not isinstance(key, str):
+            result["error"] = "idempotency_key is required."
+            continue
+        if key in seen:
+            result["error"] = "idempotency_key repeated in this batch."
+            continue
+        seen.add(key)
+        try:
+            parsed.append((result, _parse_sale(raw)))
+        except (ValueError, TypeError, KeyError, InvalidId) as e:
+            result["error"] = f"Invalid sale: {e}"
+
+    # Sales recorded by an earlier upload of the same backlog, including
+    # ones voided since
+    keys = [result["idempotency_key"] for result, _ in parsed]
+    recorded = {}
+    if keys:
+        for voided in db[VOIDED_SALES_COLLECTION].find({"_id": {"$in": keys}}):
+            recorded[voided["_id"]] = {"_id": voided["sale_id"], "invoice_number": voided.get("invoice_number")}
+        recorded.update((sale["idempotency_key"], sale) for sale in db.sales.find(
+            {"idempotency_key": {"$in": keys}}, {"idempotency_key": 1, "invoice_number": 1}))
+
+    # Every referenced batch in one query
+    medicine_ids = {med_id for _, fields in parsed for med_id, _, _ in fields["items"]}
+    meds = {med["_id"]: med for med in db.medicines.find(
+        {"_id": {"$in": list(medicine_ids)}}, INGEST_FIELDS)} if medicine_ids else {}
+
+    accepted = []  # (result, sale document)
+    units_by_medicine = {}
+    for result, fields in parsed:
+        existing = recorded.get(result["idempotency_key"])
+        if existing:
+            result.update(status="duplicate", sale_id=str(existing["_id"]),
+                          invoice_number=existing.get("invoice_number"))
+            continue
+        missing = [str(med_id) for med_id, _, _ in fields["items"] if med_id not in meds]
+        if missing:
+            result["error"] = f"Unknown medicine {', '.join(missing)}."
+            continue
+        sold_at = fields["date"] or now
+        expired = [meds[med_id].get("name", str(med_id)) for med_id, _, _ in fields["items"]
+                   if isinstance(meds[med_id].get("expiry_date"), datetime) and meds[med_id]["expiry_date"] <= sold_at]
+        if expired:
+            result["error"] = f"Expired batch of {', '.join(expired)}."
+            continue
+
+        items = [_line_item(meds[med_id], strips, units) for med_id, strips, units in fields["items"]]
+        needed = {}
+        for item in items:
+            needed[item["medicine_id"]] = needed.get(item["medicine_id"], 0) + item["total_units"]
+        # Earlier sales in the batch draw on the same stock
+        short = [med_id for med_id, units in needed.items()
+                 if units_by_medicine.get(med_id, 0) + units > (meds[med_id].get("quantity") or 0)]
+        if short:
+            result["error"] = f"Not enough stock of {', '.join(meds[med_id].get('name', '') for med_id in short)}."
+            continue
+        for med_id, units in needed.items():
+            units_by_medicine[med_id] = units_by_medicine.get(med_id, 0) + units
+
+        accepted.append((result, {
+            "idempotency_key": result["idempotency_key"],
+            "customer_id": fields["customer_id"],
+            "payment_method": fields["payment_method"],
+            "discount": fields["discount"],
+            "total_amount": sum(item["total"] for item in items) - fields["discount"],
+            "items": items,
+            "date": sold_at
+        }))
+
+    if not accepted:
+        return results, {}
+
+    for (_, sale), number in zip(accepted, invoice_numbers.reserve(len(accepted))):
+        sale["invoice_number"] = number
+    sale_docs = [sale for _, sale in accepted]
+
+    def record_batch(session):
+        deduct_stock(db, units_by_medicine, session=session)
+        try:
+            db.sales.insert_many(sale_docs, session=session)
+        except (BulkWriteError, DuplicateKeyError):
+            if session is None:
+                # No transaction to roll back: undo the decrement and the sales inserted before the conflict
+                db.sales.delete_many({"_id": {"$in": [sale["_id"] for sale in sale_docs]}})
+                restore_stock(db, units_by_medicine)
+            raise
+        movements = []
+        for sale in sale_docs:
+            sold = {}
+            for item in sale["items"]:
+                sold[item["medicine_id"]] = sold.get(item["medicine_id"], 0) + item["total_units"]
+            movements += stock_movements(sold, -1, "sold", sale["_id"], now)
+        record_movements(db, movements, session=session)
+        db[ROLLUP_COLLECTION].bulk_write([rollup_update(sale, tz) for sale in sale_docs], session=session)
+        customer_ops = [op for op in (customer_stats_update(sale) for sale in sale_docs) if op is not None]
+        if customer_ops:
+            db.customers.bulk_write(customer_ops, session=session)
+        refresh_stock_flags(db, units_by_medicine, session=session)
+
+    try:
+        run_transaction(client, record_batch)
+    except (BulkWriteError, DuplicateKeyError):
+        # Another upload of the same backlog won the race; a retry reports them as duplicates
+        raise BatchConflict("Some of these sales were recorded concurrently. Retry the batch.")
+
+    for result, sale in accepted:
+        result.update(status="created", sale_id=str(sale["_id"]), invoice_number=sale["invoice_number"])
+    return results, units_by_medicine
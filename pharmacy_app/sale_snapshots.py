@@ -0,0 +1,65 @@
+from pymongo import UpdateOne
+
+
+# Batch details copied into every sale line at checkout, so invoices and
+# reports read the sale alone and keep showing what was charged after the
+# batch is edited or deleted.
+ITEM_SNAPSHOT_FIELDS = ["name", "batch_number", "units_per_strip", "price_per_strip", "price_per_unit"]
+
+
+def item_snapshot(med):
+    """Snapshot fields for a sale line from the batch it was sold from."""
+    return {field: med.get(field) for field in ITEM_SNAPSHOT_FIELDS}
+
+
+def unsnapshotted_ids(sales):
+    """medicine_ids of lines recorded before snapshots, across a list of sales."""
+    return {item["medicine_id"] for sale in sales for item in sale.get("items", []) if "name" not in item}
+
+
+def backfill_item_snapshots(db, batch_size=500):
+    """Copy batch details into sale lines recorded before snapshots.
+
+    Uses the batches' current prices, the closest record left of what was
+    charged; line totals already stored are kept. Lines whose batch has
+    since been deleted are left as they are. Only the snapshot fields of
+    each line are written, so refunds recorded meanwhile are kept, but run
+    it while the app is idle. Returns the number of sales updated.
+    """
+    updated = 0
+    batch = []
+    cursor = db.sales.find({"items": {"$elemMatch": {"name": {"$exists": False}}}}, {"items": 1}).batch_size(batch_size)
+    for sale in cursor:
+        batch.append(sale)
+        if len(batch) == batch_size:
+            updated += _backfill_batch(db, batch)
+            batch = []
+    if batch:
+        updated += _backfill_batch(db, batch)
+    return updated
+
+
+def _backfill_batch(db, sales):
+    projection = {field: 1 for field in ITEM_SNAPSHOT_FIELDS}
+    meds = {med["_id"]: med for med in db.medicines.find({"_id": {"$in": list(unsnapshotted_ids(sales))}}, projection)}
+    ops = []
+    for sale in sales:
+        match = {"_id": sale["_id"]}
+        fields = {}
+        for index, item in enumerate(sale["items"]):
+            med = meds.get(item["medicine_id"])
+            if "name" in item or med is None:
+                continue
+            prefix = f"items.{index}."
+            # Skip the line if the items moved since they were read
+            match[prefix + "medicine_id"] = item["medicine_id"]
+            match[prefix + "name"] = {"$exists": False}
+            fields.update({prefix + field: value for field, value in item_snapshot(med).items()})
+            if "total" not in item:
+                fields[prefix + "total"] = (item.get("strips", 0) * (med.get("price_per_strip") or 0)
+                                            + item.get("units", 0) * (med.get("price_per_unit") or 0))
+        if fields:
+            ops.append(UpdateOne(match, {"$set": fields}))
+    if not ops:
+        return 0
+    return db.sales.bulk_write(ops, ordered=False).matched_count
@@ -16,7 +16,8 @@ document.addEventListener("DOMContentLoaded", function () {
   const hiddenCustomerIdInput = document.getElementById("selected_customer_id");
   const clearCustomerButton = document.getElementById("clear-customer");
 
-  let selectedItems = {}; // { medicineId: { data, strips, units } }
+  // Lines are per medicine name; the server splits each across batches, earliest expiry first
+  let selectedItems = {}; // { name: { data, stock, batches, strips, units } }
 
   // Debounce utility
   function debounce(func, delay) {
@@ -123,6 +124,48 @@ document.addEventListener("DOMContentLoaded", function () {
     }
   });
 
+  // =========================
+  // Catalog Snapshot
+  // =========================
+  // Sellable batches fetched once in the background (revalidated by ETag),
+  // used when the search API is slow or unreachable.
+  const SEARCH_TIMEOUT_MS = 1500;
+  let catalog = null;
+
+  async function loadCatalog() {
+    try {
+      const response = await fetch("/api/catalog_snapshot", { cache: "no-cache" });
+      if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+      const snapshot = await response.json();
+      catalog = snapshot.rows.map((row) => {
+        const med = {};
+        snapshot.fields.forEach((field, i) => (med[field] = row[i]));
+        return med;
+      });
+      // Same per-name totals as the search API attaches to each batch
+      const totals = {};
+      catalog.forEach((med) => {
+        totals[med.name] = totals[med.name] || { quantity: 0, batches: 0 };
+        totals[med.name].quantity += med.quantity;
+        totals[med.name].batches += 1;
+      });
+      catalog.forEach((med) => {
+        med.name_quantity = totals[med.name].quantity;
+        med.name_batches = totals[med.name].batches;
+      });
+    } catch (error) {
+      console.warn("Catalog snapshot unavailable:", error);
+    }
+  }
+
+  // Same matching as /api/search_medicines: name contains query, name then expiry order
+  function searchCatalog(query, limit = 10) {
+    const needle = query.toLowerCase();
+    return catalog.filter((med) => (med.name || "").toLowerCase().includes(needle)).slice(0, limit);
+  }
+
+  loadCatalog();
+
   // =========================
   // Medicine Search
   // =========================
@@ -132,15 +175,23 @@ document.addEventListener("DOMContentLoaded", function () {
       medicineResultsContainer.style.display = "none";
       return;
     }
+    const controller = new AbortController();
+    const timer = catalog ? setTimeout(() => controller.abort(), SEARCH_TIMEOUT_MS) : null;
     try {
-      const response = await fetch(`/api/search_medicines?query=${encodeURIComponent(query)}`);
+      const response = await fetch(`/api/search_medicines?query=${encodeURIComponent(query)}`, { signal: controller.signal });
       if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
       const medicines = await response.json();
       displayMedicineResults(medicines);
     } catch (error) {
+      if (catalog) {
+        displayMedicineResults(searchCatalog(query));
+        return;
+      }
       console.error("Error fetching medicines:", error);
       medicineResultsContainer.innerHTML = `<div class="list-group-item text-danger">Error searching medicines.</div>`;
       medicineResultsContainer.style.display = "block";
+    } finally {
+      clearTimeout(timer);
     }
   }, 300);
 
@@ -148,22 +199,36 @@ document.addEventListener("DOMContentLoaded", function () {
     debouncedMedicineSearch(medicineSearchInput.value.trim());
   });
 
+  // One entry per medicine name. Batches come earliest expiry first, so the
+  // first one carries the strip size and prices the sale is charged at; the
+  // stock counts every sellable batch, not just the ones returned.
+  function groupByName(medicines) {
+    const groups = {};
+    medicines.forEach((med) => {
+      if (!groups[med.name]) {
+        groups[med.name] = { data: med, stock: med.name_quantity, batches: med.name_batches };
+      }
+    });
+    return Object.values(groups);
+  }
+
   function displayMedicineResults(medicines) {
     medicineResultsContainer.innerHTML = "";
     if (medicines.length === 0) {
       medicineResultsContainer.innerHTML = `<div class="list-group-item">No available medicines found.</div>`;
     } else {
-      medicines.forEach((med) => {
+      groupByName(medicines).forEach((group) => {
+        const med = group.data;
         const item = document.createElement("button");
         item.type = "button";
         item.classList.add("list-group-item", "list-group-item-action");
         item.innerHTML = `
-                ${med.name} <small class="text-muted">(Batch: ${med.batch_number})</small>
+                ${med.name} <small class="text-muted">(${group.batches} batch${group.batches > 1 ? "es" : ""})</small>
                 <span class="badge bg-secondary float-end ms-2">
-                    Stock: ${med.quantity} | ₹${parseFloat(med.price_per_strip).toFixed(2)}/strip
+                    Stock: ${group.stock} | ₹${parseFloat(med.price_per_strip).toFixed(2)}/strip
                 </span>`;
         item.addEventListener("click", () => {
-          addSelectedItem(med);
+          addSelectedItem(group);
         });
         medicineResultsContainer.appendChild(item);
       });
@@ -171,12 +236,13 @@ document.addEventListener("DOMContentLoaded", function () {
     medicineResultsContainer.style.display = "block";
   }
 
-  function addSelectedItem(medicineData) {
-    if (selectedItems[medicineData._id]) {
-      alert(`${medicineData.name} (Batch: ${medicineData.batch_number}) is already added.`);
+  function addSelectedItem(group) {
+    const medicineData = group.data;
+    if (selectedItems[medicineData.name]) {
+      alert(`${medicineData.name} is already added.`);
       return;
     }
-    selectedItems[medicineData._id] = { data: medicineData, strips: 0, units: 0 };
+    selectedItems[medicineData.name] = { data: medicineData, stock: group.stock, batches: group.batches, strips: 0, units: 0 };
     renderSelectedItemsTable();
     calculateTotal();
     medicineSearchInput.value = "";
@@ -197,15 +263,15 @@ document.addEventListener("DOMContentLoaded", function () {
     for (const medId in selectedItems) {
         const item = selectedItems[medId];
         const med = item.data;
-        const stripsInStock = Math.floor(med.quantity / med.units_per_strip);
-        const unitsInStock = med.quantity % med.units_per_strip;
+        const stripsInStock = Math.floor(item.stock / med.units_per_strip);
+        const unitsInStock = item.stock % med.units_per_strip;
         const itemTotal = (med.price_per_strip * item.strips) + (med.price_per_unit * item.units);
 
         const row = document.createElement("tr");
         row.dataset.medicineId = medId;
         row.innerHTML = `
             <td>${med.name}</td>
-            <td>${med.batch_number}</td>
+            <td>${item.batches > 1 ? `Earliest expiry of ${item.batches}` : med.batch_number}</td>
             <td class="text-end">₹${parseFloat(med.price_per_strip).toFixed(2)}/strip</br>
             ₹${parseFloat(med.price_per_unit).toFixed(2)}/unit</td>
             <td class="text-center">${stripsInStock} strips, ${unitsInStock} units</td>
@@ -237,18 +303,19 @@ document.addEventListener("DOMContentLoaded", function () {
       const input = event.target;
       const medId = input.dataset.medicineId;
       const med = selectedItems[medId].data;
-      let strips = parseInt(document.querySelector(`.item-strips[data-medicine-id="${medId}"]`).value, 10) || 0;
-      let units = parseInt(document.querySelector(`.item-units[data-medicine-id="${medId}"]`).value, 10) || 0;
+      const stock = selectedItems[medId].stock;
+      let strips = parseInt(document.querySelector(`.item-strips[data-medicine-id="${CSS.escape(medId)}"]`).value, 10) || 0;
+      let units = parseInt(document.querySelector(`.item-units[data-medicine-id="${CSS.escape(medId)}"]`).value, 10) || 0;
 
       // Total units calculation
       const totalUnitsRequested = (strips * med.units_per_strip) + units;
-      if (totalUnitsRequested > med.quantity) {
-          alert(`Only ${med.quantity} units available in stock for ${med.name}.`);
+      if (totalUnitsRequested > stock) {
+          alert(`Only ${stock} units available in stock for ${med.name}.`);
           // Reduce to max possible
-          strips = Math.floor(med.quantity / med.units_per_strip);
-          units = med.quantity % med.units_per_strip;
-          document.querySelector(`.item-strips[data-medicine-id="${medId}"]`).value = strips;
-          document.querySelector(`.item-units[data-medicine-id="${medId}"]`).value = units;
+          strips = Math.floor(stock / med.units_per_strip);
+          units = stock % med.units_per_strip;
+          document.querySelector(`.item-strips[data-medicine-id="${CSS.escape(medId)}"]`).value = strips;
+          document.querySelector(`.item-units[data-medicine-id="${CSS.escape(medId)}"]`).value = units;
       }
 
       // Save values
@@ -320,8 +387,8 @@ document.addEventListener("DOMContentLoaded", function () {
           // Hidden fields
           const idInput = document.createElement("input");
           idInput.type = "hidden";
-          idInput.name = "medicine_ids[]";
-          idInput.value = medId;
+          idInput.name = "names[]";
+          idInput.value = item.data.name;
           hiddenItemFieldsContainer.appendChild(idInput);
 
           const stripsInput = document.createElement("input");
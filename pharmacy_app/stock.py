@@ -0,0 +1,61 @@
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+
+class InsufficientStock(Exception):
+    pass
+
+
+def run_transaction(client, callback):
+    """Run callback(session) inside a multi-document transaction.
+
+    Standalone mongod servers do not support transactions; there the
+    callback runs without a session and each write is only atomic on its own.
+    deduct_stock() then undoes its own partial decrements, but if a later
+    write in the callback fails the earlier ones are not rolled back.
+    """
+    try:
+        with client.start_session() as session:
+            return session.with_transaction(callback)
+    except OperationFailure as e:
+        # 20 = IllegalOperation ("Transaction numbers are only allowed on a replica set member or mongos")
+        if e.code != 20:
+            raise
+    return callback(None)
+
+
+def deduct_stock(db, units_by_medicine, session=None):
+    """Decrement stock for several medicines in one bulk_write.
+
+    Every decrement only applies while the batch still holds enough units,
+    so stock can never go negative. If any batch falls short
+    InsufficientStock is raised, which aborts the surrounding transaction.
+    Without a transaction (session is None) the decrements are applied one
+    at a time and those already applied are put back before raising.
+    """
+    if not units_by_medicine:
+        return
+    if session is None:
+        applied = {}
+        for med_id, units in units_by_medicine.items():
+            result = db.medicines.update_one({"_id": med_id, "quantity": {"$gte": units}}, {"$inc": {"quantity": -units}})
+            if result.matched_count != 1:
+                restore_stock(db, applied)
+                raise InsufficientStock("Not enough stock left for one or more items. Please check quantities and try again.")
+            applied[med_id] = units
+        return
+    ops = [
+        UpdateOne({"_id": med_id, "quantity": {"$gte": units}}, {"$inc": {"quantity": -units}})
+        for med_id, units in units_by_medicine.items()
+    ]
+    result = db.medicines.bulk_write(ops, ordered=False, session=session)
+    if result.matched_count != len(ops):
+        raise InsufficientStock("Not enough stock left for one or more items. Please check quantities and try again.")
+
+
+def restore_stock(db, units_by_medicine, session=None):
+    """Put units back on several medicines in one bulk_write."""
+    if not units_by_medicine:
+        return
+    ops = [UpdateOne({"_id": med_id}, {"$inc": {"quantity": units}}) for med_id, units in units_by_medicine.items()]
+    db.medicines.bulk_write(ops, ordered=False, session=session)
@@ -0,0 +1,168 @@
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+
+
+# Append-only history of every change to a batch's quantity:
+#   stock_movements: {medicine_id, delta, reason, ref, at}
+# reason is one of received, adjusted, removed, sold, voided, refunded,
+# imported; ref points at the sale, refund or import that caused it.
+#
+# Periodic snapshots of each batch's quantity (flask snapshot-stock):
+#   stock_snapshots: {medicine_id, quantity, at}
+# Stock at any moment is the nearest earlier snapshot plus the movements
+# after it, both read through (medicine_id, at) indexes. Batches stocked
+# before the ledger existed only become reconstructible from their first
+# snapshot, so run snapshot-stock once right after deploying the ledger;
+# verify_stock() skips batches that have no snapshot yet.
+MOVEMENTS = "stock_movements"
+SNAPSHOTS = "stock_snapshots"
+
+LEDGER_BATCH_SIZE = 500
+
+
+def movement(med_id, delta, reason, ref=None, at=None):
+    return {"medicine_id": med_id, "delta": delta, "reason": reason, "ref": ref, "at": at or datetime.utcnow()}
+
+
+def record_movements(db, movements, session=None):
+    """Append movements in one insert; zero deltas are dropped."""
+    movements = [m for m in movements if m["delta"]]
+    if movements:
+        db[MOVEMENTS].insert_many(movements, ordered=False, session=session)
+
+
+def stock_movements(units_by_medicine, sign, reason, ref=None, at=None):
+    """Movements for a {medicine _id: units} map as used by deduct_stock()/restore_stock()."""
+    at = at or datetime.utcnow()
+    return [movement(med_id, sign * units, reason, ref, at) for med_id, units in units_by_medicine.items()]
+
+
+def overwrite_stock(db, med_id, update, session=None):
+    """$set an edit form's fields and record the quantity change against what was stored.
+
+    The previous quantity comes from the same atomic update, so sales made
+    while the form was open are not lost from the ledger. Returns False if
+    the batch no longer exists.
+    """
+    before = db.medicines.find_one_and_update({"_id": med_id}, {"$set": update}, projection={"quantity": 1},
+                                              return_document=ReturnDocument.BEFORE, session=session)
+    if before is None:
+        return False
+    if "quantity" in update:
+        record_movements(db, [movement(med_id, update["quantity"] - (before.get("quantity") or 0), "adjusted")],
+                         session=session)
+    return True
+
+
+def remove_batch(db, med_id, session=None):
+    """Delete a batch, writing off whatever stock it still held."""
+    removed = db.medicines.find_one_and_delete({"_id": med_id}, projection={"quantity": 1}, session=session)
+    if removed is not None:
+        record_movements(db, [movement(med_id, -(removed.get("quantity") or 0), "removed")], session=session)
+    return removed is not None
+
+
+def stock_at(db, med_id, at):
+    """Quantity of a batch at a past moment: {quantity, snapshot_at, movements}.
+
+    Returns None if the batch has neither a snapshot nor a movement by then.
+    """
+    snapshot = db[SNAPSHOTS].find_one({"medicine_id": med_id, "at": {"$lte": at}},
+                                      sort=[("at", DESCENDING)])
+    since = {"$gt": snapshot["at"], "$lte": at} if snapshot else {"$lte": at}
+    movements = list(db[MOVEMENTS].find({"medicine_id": med_id, "at": since}, {"_id": 0, "medicine_id": 0})
+                     .sort("at", ASCENDING))
+    if snapshot is None and not movements:
+        return None
+    base = snapshot["quantity"] if snapshot else 0
+    return {
+        "quantity": base + sum(m["delta"] for m in movements),
+        "snapshot_at": snapshot["at"] if snapshot else None,
+        "movements": movements
+    }
+
+
+def _ledger_state(db, med_ids):
+    """{medicine _id: (snapshot quantity, snapshot time, delta since, movements since)} for a chunk of batches."""
+    snapshots = {
+        s["_id"]: s for s in db[SNAPSHOTS].aggregate([
+            {"$match": {"medicine_id": {"$in": med_ids}}},
+            {"$sort": {"medicine_id": 1, "at": -1}},
+            {"$group": {"_id": "$medicine_id", "quantity": {"$first": "$quantity"}, "at": {"$first": "$at"}}}
+        ])
+    }
+    # One indexed range per batch: everything after its latest snapshot
+    ranges = [
+        {"medicine_id": med_id, "at": {"$gt": snapshots[med_id]["at"]}} if med_id in snapshots
+        else {"medicine_id": med_id}
+        for med_id in med_ids
+    ]
+    sums = {
+        s["_id"]: s for s in db[MOVEMENTS].aggregate([
+            {"$match": {"$or": ranges}},
+            {"$group": {"_id": "$medicine_id", "delta": {"$sum": "$delta"}, "count": {"$sum": 1}}}
+        ])
+    }
+    state = {}
+    for med_id in med_ids:
+        snapshot = snapshots.get(med_id)
+        moved = sums.get(med_id, {})
+        state[med_id] = (
+            snapshot["quantity"] if snapshot else None,
+            snapshot["at"] if snapshot else None,
+            moved.get("delta", 0),
+            moved.get("count", 0)
+        )
+    return state
+
+
+def _chunks(db, batch_size):
+    """(read time, batches) for the catalog, one query per chunk so each is stamped when it was read."""
+    after = None
+    while True:
+        read_at = datetime.utcnow()
+        chunk = list(db.medicines.find({"_id": {"$gt": after}} if after else {}, {"quantity": 1})
+                     .sort("_id", ASCENDING).limit(batch_size))
+        if not chunk:
+            return
+        yield read_at, chunk
+        after = chunk[-1]["_id"]
+
+
+def snapshot_stock(db, batch_size=LEDGER_BATCH_SIZE):
+    """Snapshot every batch that has moved since its last snapshot, or never had one.
+
+    Reads the catalog in chunks of batch_size, each snapshot stamped with
+    the time its chunk was read so movements written while earlier chunks
+    were processed are not counted twice. Returns the number of snapshots written.
+    """
+    written = 0
+    for read_at, chunk in _chunks(db, batch_size):
+        state = _ledger_state(db, [med["_id"] for med in chunk])
+        snapshots = [
+            {"medicine_id": med["_id"], "quantity": med.get("quantity") or 0, "at": read_at}
+            for med in chunk
+            if state[med["_id"]][1] is None or state[med["_id"]][3]
+        ]
+        if snapshots:
+            db[SNAPSHOTS].insert_many(snapshots, ordered=False)
+            written += len(snapshots)
+    return written
+
+
+def verify_stock(db, batch_size=LEDGER_BATCH_SIZE):
+    """Yield (medicine _id, stored quantity, ledger quantity) for every batch that disagrees.
+
+    Holds one chunk of batch_size batches in memory at a time. Batches with
+    no snapshot have no known starting quantity (they may predate the
+    ledger) and are yielded with a ledger quantity of None instead.
+    """
+    for _, chunk in _chunks(db, batch_size):
+        state = _ledger_state(db, [med["_id"] for med in chunk])
+        for med in chunk:
+            base, _, delta, _ = state[med["_id"]]
+            if base is None:
+                yield med["_id"], med.get("quantity") or 0, None
+            elif base + delta != (med.get("quantity") or 0):
+                yield med["_id"], med.get("quantity") or 0, base + delta
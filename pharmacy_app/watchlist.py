@@ -0,0 +1,128 @@
+import threading
+import time
+from datetime import timedelta
+
+from pymongo import UpdateMany, UpdateOne
+
+
+# Alert thresholds per category. A batch can override either one with its
+# own low_stock_threshold / expiry_alert_days fields (set on the edit form).
+CATEGORY_THRESHOLDS = {
+    "medicine": {"low_stock": 10, "expiry_days": 30},
+    "general": {"low_stock": 10, "expiry_days": 30},
+}
+
+# Watch fields kept on every medicines document by the write paths:
+#   low_stock_at     resolved low-stock threshold, in units
+#   low_stock        quantity < low_stock_at
+#   expiry_alert_at  when the batch enters the expiry alert list; the
+#                    (expiry_alert_at) index is the time-ordered expiry queue
+#   expired          set by the sweep once expiry_date has passed
+
+
+def threshold_overrides(form):
+    """Per-batch thresholds from an edit form; blank fields fall back to the category default."""
+    overrides = {}
+    for field in ("low_stock_threshold", "expiry_alert_days"):
+        value = form.get(field, '').strip()
+        overrides[field] = int(value) if value else None
+    return overrides
+
+
+def thresholds(med):
+    """(low stock threshold, expiry alert days) for a medicine document."""
+    defaults = CATEGORY_THRESHOLDS["general" if med.get("general") else "medicine"]
+    low_stock = med.get("low_stock_threshold")
+    expiry_days = med.get("expiry_alert_days")
+    return (
+        defaults["low_stock"] if low_stock is None else low_stock,
+        defaults["expiry_days"] if expiry_days is None else expiry_days
+    )
+
+
+def watch_fields(med, now):
+    """Watch field values for a full medicine document, to store alongside it."""
+    low_stock_at, expiry_days = thresholds(med)
+    expiry_date = med.get("expiry_date")
+    return {
+        "low_stock_at": low_stock_at,
+        "low_stock": (med.get("quantity") or 0) < low_stock_at,
+        "expiry_alert_at": expiry_date - timedelta(days=expiry_days) if expiry_date else None,
+        "expired": bool(expiry_date and expiry_date <= now)
+    }
+
+
+# low_stock_at, resolved in the query for documents not yet backfilled
+LOW_STOCK_AT = {"$ifNull": ["$low_stock_at", {"$ifNull": ["$low_stock_threshold", {"$cond": [
+    "$general", CATEGORY_THRESHOLDS["general"]["low_stock"], CATEGORY_THRESHOLDS["medicine"]["low_stock"]
+]}]}]}
+
+
+def stock_flag_updates(med_ids):
+    """Two updates re-deriving low_stock from the stored threshold after quantities changed."""
+    med_ids = list(med_ids)
+    return [
+        UpdateMany({"_id": {"$in": med_ids}, "$expr": {"$lt": ["$quantity", LOW_STOCK_AT]}},
+                   {"$set": {"low_stock": True}}),
+        UpdateMany({"_id": {"$in": med_ids}, "$expr": {"$gte": ["$quantity", LOW_STOCK_AT]}},
+                   {"$set": {"low_stock": False}}),
+    ]
+
+
+def refresh_stock_flags(db, med_ids, session=None):
+    """Call after any $inc on quantity; a constant two-update round trip however many batches changed."""
+    if med_ids:
+        db.medicines.bulk_write(stock_flag_updates(med_ids), ordered=False, session=session)
+
+
+def sweep_expired(db, now):
+    """Flag batches whose expiry date has passed. Returns the _ids newly flagged.
+
+    Batches stored before the watch fields existed have no expired field and are flagged too.
+    """
+    expired_ids = [med["_id"] for med in db.medicines.find(
+        {"expired": {"$ne": True}, "expiry_date": {"$lte": now}}, {"_id": 1})]
+    if expired_ids:
+        db.medicines.update_many({"_id": {"$in": expired_ids}}, {"$set": {"expired": True}})
+    return expired_ids
+
+
+class ExpirySweeper:
+    """Runs sweep_expired() at most once per `interval` seconds per process.
+
+    Scheduled runs (flask sweep-expired from cron) do the same work; this
+    covers deployments without a scheduler.
+    """
+
+    def __init__(self, interval=900):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last_run = None
+
+    def maybe_sweep(self, db, now):
+        """Sweep if due; returns the _ids flagged, or an empty list."""
+        with self._lock:
+            if self._last_run is not None and time.monotonic() - self._last_run < self.interval:
+                return []
+            self._last_run = time.monotonic()
+        return sweep_expired(db, now)
+
+
+def backfill_watch_fields(db, now, batch_size=1000, missing_only=False):
+    """Store the watch fields on every medicine. Returns the number of documents updated.
+
+    With missing_only, only documents that never had them are read, through
+    the (expiry_alert_at) index; cheap enough to run on every startup.
+    """
+    updated = 0
+    ops = []
+    query = {"expiry_alert_at": {"$exists": False}} if missing_only else {}
+    projection = {"quantity": 1, "expiry_date": 1, "general": 1, "low_stock_threshold": 1, "expiry_alert_days": 1}
+    for med in db.medicines.find(query, projection).batch_size(batch_size):
+        ops.append(UpdateOne({"_id": med["_id"]}, {"$set": watch_fields(med, now)}))
+        if len(ops) == batch_size:
+            updated += db.medicines.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += db.medicines.bulk_write(ops, ordered=False).modified_count
+    return updated